@@ -10,7 +10,29 @@ provides two options to send an email message:
 
 * `send_mail()`_ function for simple usage,
 * `EmailMessage`_ class for advanced usage.
+
+The `send_mass_mail()`_ function sends a personalised message to many
+recipients using the same template. It is built on top of
+`iter_rendered_messages()`_ and `send_messages()`_ that can be used directly
+for streaming processing of large mailings. The
+`iter_personalized_messages()`_ function renders the shared content only once
+for all recipients. The `iter_queryset_messages()`_ function renders the
+messages for the objects of a queryset in batches with prefetched relations.
+The `send_localized_mail()`_ and `iter_localized_messages()`_ functions
+render the messages in the languages of the recipients, grouped by
+language.
 """
 
-from .utils import send_mail
-from .message import EmailMessage
\ No newline at end of file
+import django
+
+# Django < 3.2 does not discover the application config automatically, and
+# Django 3.2 and 4.0 warn about the setting.
+if django.VERSION < (3, 2):
+    default_app_config = 'mail_templated.apps.MailTemplatedConfig'
+
+from .utils import (send_mail, send_mass_mail, iter_rendered_messages,
+                    send_messages)
+from .message import EmailMessage
+from .personalize import iter_personalized_messages
+from .bulk import iter_queryset_messages
+from .i18n import iter_localized_messages, send_localized_mail
\ No newline at end of file
@@ -0,0 +1,183 @@
+"""
+.. module:: mail_templated.aio
+   :synopsis: Asyncio interface of django-mail-templated package.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+
+The template rendering and the standard Django email backends are blocking,
+so they are offloaded to an executor (the default thread pool of the event
+loop unless specified). The messages are rendered in the language that is
+active in the calling coroutine. If the email backend has a coroutine method
+``asend_messages()`` then it is used instead of ``send_messages()``.
+
+This module requires Python 3.5 or later.
+"""
+
+import asyncio
+
+from django.core import mail
+from django.utils import translation
+
+from .cache import template_cache
+from .conf import app_settings
+from .message import EmailMessage
+
+
+async def asend_message(message, fail_silently=False, clean=False,
+                        executor=None):
+    """
+    Render the message if it is not rendered yet and send it.
+
+    This is what :meth:`EmailMessage.asend()
+    <mail_templated.EmailMessage.asend>` does.
+
+    Arguments
+    ---------
+    message : EmailMessage
+        The message to send.
+
+    Keyword Arguments
+    -----------------
+    fail_silently : bool
+        See :func:`mail_templated.send_mail()`.
+    clean : bool
+        If ``True``, remove any template specific properties from the
+        message object. Default is ``False``.
+    executor : concurrent.futures.Executor
+        The executor for the blocking operations.
+
+    Returns
+    -------
+    int
+        The number of successfully delivered messages (0 or 1).
+    """
+    loop = asyncio.get_event_loop()
+    if not message.is_rendered:
+        await loop.run_in_executor(executor, _render_message, message,
+                                   translation.get_language())
+    if clean:
+        message.clean()
+    if not message.recipients():
+        # Don't bother creating the network connection if there's nobody to
+        # send to.
+        return 0
+    connection = message.get_connection(fail_silently)
+    return await asend_messages(connection, [message], executor)
+
+
+def _render_message(message, language, clean=False):
+    """
+    Render the message in the language.
+
+    The executor threads do not inherit the active language of the event
+    loop thread, so it is passed explicitly.
+    """
+    with translation.override(language):
+        message.render(clean=clean)
+
+
+async def asend_messages(connection, messages, executor=None):
+    """
+    Send the messages with the ``asend_messages()`` coroutine of the email
+    backend, or with ``send_messages()`` in the executor if the backend is
+    not async-capable.
+    """
+    asend = getattr(connection, 'asend_messages', None)
+    if asend is not None:
+        return await asend(messages) or 0
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        executor, connection.send_messages, messages) or 0
+
+
+async def asend_mail(template_name, context, from_email, recipient_list,
+                     fail_silently=False, auth_user=None, auth_password=None,
+                     connection=None, executor=None, **kwargs):
+    """
+    Asynchronous version of :func:`mail_templated.send_mail()`.
+
+    Keyword Arguments
+    -----------------
+    executor : concurrent.futures.Executor
+        The executor for the blocking operations.
+
+    Other arguments are the same as for the
+    :func:`mail_templated.send_mail()` function.
+    """
+    connection = connection or mail.get_connection(username=auth_user,
+                                                   password=auth_password,
+                                                   fail_silently=fail_silently)
+    clean = kwargs.pop('clean', True)
+    message = EmailMessage(template_name, context, from_email, recipient_list,
+                           connection=connection, **kwargs)
+    return await asend_message(message, clean=clean, executor=executor)
+
+
+async def asend_mass_mail(template_name, datatuple, from_email=None,
+                          fail_silently=False, auth_user=None,
+                          auth_password=None, connection=None, concurrency=None,
+                          executor=None, **kwargs):
+    """
+    Asynchronous version of :func:`mail_templated.send_mass_mail()`.
+
+    The messages are rendered and sent concurrently over a single connection.
+    The ``datatuple`` is consumed lazily, and no more than ``concurrency``
+    messages are processed at a time.
+
+    Keyword Arguments
+    -----------------
+    concurrency : int
+        The maximum number of messages processed at a time. Defaults to the
+        ``MAIL_TEMPLATED_ASYNC_CONCURRENCY`` setting.
+    executor : concurrent.futures.Executor
+        The executor for the blocking operations.
+
+    Other arguments are the same as for the
+    :func:`mail_templated.send_mass_mail()` function.
+
+    Returns
+    -------
+    int
+        The number of successfully delivered messages.
+    """
+    connection = connection or mail.get_connection(username=auth_user,
+                                                   password=auth_password,
+                                                   fail_silently=fail_silently)
+    concurrency = concurrency or app_settings.ASYNC_CONCURRENCY
+    clean = kwargs.pop('clean', True)
+    alternatives = kwargs.pop('alternatives', None) or []
+    loop = asyncio.get_event_loop()
+    language = translation.get_language()
+    template = await loop.run_in_executor(
+        executor, template_cache.get_template, template_name)
+
+    async def send(context, recipient_list):
+        message = EmailMessage(template_name, context, from_email,
+                               recipient_list, alternatives=list(alternatives),
+                               connection=connection, **kwargs)
+        message.template = template
+        await loop.run_in_executor(executor, _render_message, message,
+                                   language, clean)
+        return await asend_messages(connection, [message], executor)
+
+    new_connection = await loop.run_in_executor(executor, connection.open)
+    sent = 0
+    pending = set()
+    try:
+        for context, recipient_list in datatuple:
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                sent += sum(task.result() for task in done)
+            pending.add(asyncio.ensure_future(send(context, recipient_list)))
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            sent += sum(task.result() for task in done)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+    finally:
+        if new_connection:
+            await loop.run_in_executor(executor, connection.close)
+    return sent
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class MailTemplatedConfig(AppConfig):
+    name = 'mail_templated'
+    verbose_name = 'Mail Templated'
+
+    def ready(self):
+        from .warmup import warm_up
+        warm_up()
@@ -0,0 +1,173 @@
+"""
+.. module:: mail_templated.attachments
+   :synopsis: File attachments that are read on sending.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import copy
+import hashlib
+import mimetypes
+import os
+
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
+from django.test.signals import setting_changed
+
+from .cache import LRUCache
+from .conf import app_settings
+
+
+class FileContent(object):
+    """
+    The content of an attachment that is read from the file only when the
+    email message is built for sending.
+
+    The object stores only the absolute path to the file, so it is cheap to
+    share between many messages and to serialize. Pass it as the content of
+    an attachment:
+
+    .. code-block:: python
+
+        brochure = FileContent('/var/files/brochure.pdf')
+        for user in users:
+            message = EmailMessage('email/invoice.tpl', {'user': user})
+            message.attach('brochure.pdf', brochure, 'application/pdf')
+
+    Arguments
+    ---------
+    path : str
+        The path to the file.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def read(self, mimetype):
+        """
+        Read the file.
+
+        The content of ``text/*`` files is decoded as UTF-8. If this fails,
+        the mimetype is replaced with ``application/octet-stream``, like
+        :meth:`django.core.mail.EmailMessage.attach_file()` does.
+
+        Returns
+        -------
+        tuple
+            The ``(content, mimetype)`` pair.
+        """
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        if mimetype.split('/', 1)[0] == 'text':
+            try:
+                content = content.decode('utf-8')
+            except UnicodeDecodeError:
+                mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
+        return content, mimetype
+
+    def __eq__(self, other):
+        return isinstance(other, FileContent) and other.path == self.path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return '<FileContent %r>' % self.path
+
+
+def file_attachment(path, mimetype=None, filename=None):
+    """
+    Make an attachment tuple with :class:`FileContent`.
+
+    The result can be passed to the ``attachments`` argument of the
+    :class:`~mail_templated.EmailMessage` constructor and of the mass mailing
+    helpers, and it is shared between all messages.
+
+    Arguments
+    ---------
+    path : str
+        The path to the file.
+
+    Keyword Arguments
+    -----------------
+    mimetype : str
+        The mimetype of the file. It is guessed from the file name if not
+        specified.
+    filename : str
+        The file name for the recipients. Defaults to the name of the file.
+
+    Returns
+    -------
+    tuple
+        The ``(filename, content, mimetype)`` tuple.
+    """
+    filename = filename or os.path.basename(path)
+    mimetype = (mimetype or mimetypes.guess_type(filename)[0] or
+                DEFAULT_ATTACHMENT_MIME_TYPE)
+    return filename, FileContent(path), mimetype
+
+
+class AttachmentCache(LRUCache):
+    """
+    Cache of the encoded MIME parts of the attachments.
+
+    The identical attachments of different messages, for example of a mass
+    mailing, are encoded only once. The attachments are identified by the
+    file name, mimetype, message encoding and the hash of the content, or the
+    path, size and modification time for :class:`FileContent`. It is
+    configured with the ``MAIL_TEMPLATED_ATTACHMENT_CACHE_SIZE`` setting, and
+    it is disabled by default.
+    """
+
+    def __init__(self):
+        super(AttachmentCache, self).__init__(0)
+
+    @property
+    def max_size(self):
+        return app_settings.ATTACHMENT_CACHE_SIZE
+
+    def make_key(self, filename, content, mimetype, encoding):
+        """
+        Make the cache key for the attachment, or ``None`` if it can not be
+        cached.
+        """
+        if isinstance(content, FileContent):
+            try:
+                stat = os.stat(content.path)
+            except OSError:
+                return None
+            digest = (content.path, stat.st_size, stat.st_mtime)
+        elif isinstance(content, bytes):
+            digest = hashlib.sha1(content).hexdigest()
+        elif isinstance(content, type(u'')):
+            digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        else:
+            return None
+        return filename, mimetype, encoding, digest
+
+    def get_attachment(self, key, create):
+        """
+        Get a copy of the cached MIME part, or create it with the ``create``
+        function and put it to the cache.
+        """
+        attachment = self.get(key)
+        if attachment is None:
+            attachment = create()
+            self.set(key, copy.deepcopy(attachment))
+            return attachment
+        return copy.deepcopy(attachment)
+
+
+attachment_cache = AttachmentCache()
+
+
+def _clear_cache(**kwargs):
+    setting = kwargs['setting']
+    if setting == 'DEFAULT_CHARSET' or setting.startswith(
+            'MAIL_TEMPLATED_ATTACHMENT_CACHE_'):
+        attachment_cache.clear()
+
+
+setting_changed.connect(_clear_cache)
@@ -0,0 +1,125 @@
+"""
+.. module:: mail_templated.bulk
+   :synopsis: Mass mailing to the objects of a queryset.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import logging
+from timeit import default_timer
+
+from django.db import connections
+
+from .conf import app_settings
+from .utils import iter_rendered_messages
+
+logger = logging.getLogger('mail_templated')
+
+
+class QueryCounter(object):
+    """
+    Database execute wrapper that counts the queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def iter_queryset_messages(template_name, queryset, context_builder,
+                           from_email=None, relations=(), batch_size=None,
+                           on_batch=None, **kwargs):
+    """
+    Lazily render a message for each object of the queryset.
+
+    The objects are fetched in batches ordered by the primary key, and the
+    ``relations`` are prefetched for the whole batch with
+    :meth:`~django.db.models.query.QuerySet.prefetch_related()`. This way the
+    template lookups like ``{{ user.profile.company.name }}`` do not make a
+    query for every recipient. The messages of a batch are rendered together
+    and then yielded one by one.
+
+    The number of database queries made for each batch, including the queries
+    made on rendering, is reported to the ``on_batch`` callback and to the
+    ``mail_templated`` logger at the DEBUG level. The queries are counted only
+    with Django 2.0 or later.
+
+    Arguments
+    ---------
+    template_name : str
+        |template_name|
+    queryset : QuerySet
+        The objects to send the messages for. The ordering of the queryset is
+        replaced with the primary key ordering.
+    context_builder : callable
+        The function that takes an object and returns the
+        ``(context, recipient_list)`` pair for it.
+
+    Keyword Arguments
+    -----------------
+    from_email : str
+        |from_email|
+    relations : iterable
+        The relation paths to prefetch, like ``'profile__company'``.
+    batch_size : int
+        The number of objects fetched at once. Defaults to the
+        ``MAIL_TEMPLATED_QUERYSET_BATCH_SIZE`` setting.
+    on_batch : callable
+        The function that is called with a dict of batch statistics after
+        each batch is rendered: the ``batch`` number starting from 1, the
+        ``size`` of the batch, the number of ``queries`` (``None`` if not
+        supported), and the ``elapsed`` time in seconds.
+
+    Any other keyword arguments are passed to
+    :func:`~mail_templated.iter_rendered_messages()`.
+
+    Yields
+    ------
+    EmailMessage
+        Rendered message.
+    """
+    batch_size = batch_size or app_settings.QUERYSET_BATCH_SIZE
+    queryset = queryset.order_by('pk')
+    if relations:
+        queryset = queryset.prefetch_related(*relations)
+    execute_wrapper = getattr(connections[queryset.db], 'execute_wrapper',
+                              None)
+
+    def render_batch(queryset):
+        objects = list(queryset[:batch_size])
+        datatuple = [context_builder(obj) for obj in objects]
+        messages = list(iter_rendered_messages(template_name, datatuple,
+                                               from_email, **kwargs))
+        return objects, messages
+
+    number = 0
+    while True:
+        number += 1
+        start_time = default_timer()
+        if execute_wrapper is None:
+            counter = None
+            objects, messages = render_batch(queryset)
+        else:
+            counter = QueryCounter()
+            with execute_wrapper(counter):
+                objects, messages = render_batch(queryset)
+        if not objects:
+            break
+        stats = {
+            'batch': number,
+            'size': len(objects),
+            'queries': None if counter is None else counter.count,
+            'elapsed': default_timer() - start_time,
+        }
+        logger.debug('Batch %(batch)d: %(size)d messages rendered with '
+                     '%(queries)s queries in %(elapsed).3f s', stats)
+        if on_batch is not None:
+            on_batch(stats)
+        for message in messages:
+            yield message
+        if len(objects) < batch_size:
+            break
+        queryset = queryset.filter(pk__gt=objects[-1].pk)
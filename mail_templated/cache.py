@@ -0,0 +1,317 @@
+"""
+.. module:: mail_templated.cache
+   :synopsis: In-process caches of django-mail-templated package.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.template.loader import get_template
+from django.test.signals import setting_changed
+from django.utils import translation
+from django.utils.safestring import SafeData
+
+from .conf import app_settings, get_callable
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache with optional expiration.
+
+    Arguments
+    ---------
+    max_size : int
+        The maximum number of entries. The least recently used entries are
+        evicted when the limit is reached. The cache is disabled if it is
+        ``0``.
+
+    Keyword Arguments
+    -----------------
+    timeout : int
+        The number of seconds after that the entry is expired. The entries
+        never expire if it is ``None`` (default).
+    """
+
+    def __init__(self, max_size, timeout=None):
+        self._max_size = max_size
+        self._timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    def get(self, key, default=None):
+        """
+        Get the value by key, or ``default`` if it is missing or expired.
+        """
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # Move to the end as the most recently used.
+            self._data[key] = value, expires
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Put the value to the cache. Does nothing if the cache is disabled.
+        """
+        max_size = self.max_size
+        if not max_size:
+            return
+        timeout = self.timeout
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, expires
+            while len(self._data) > max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries and reset the statistics.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Get the cache statistics.
+
+        Returns
+        -------
+        dict
+            The numbers of ``hits``, ``misses`` and ``evictions``, current
+            ``size`` and ``max_size`` of the cache.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'max_size': self.max_size,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TemplateCache(LRUCache):
+    """
+    Cache of the compiled templates.
+
+    It is configured with the ``MAIL_TEMPLATED_TEMPLATE_CACHE_SIZE``,
+    ``MAIL_TEMPLATED_TEMPLATE_CACHE_TIMEOUT`` and
+    ``MAIL_TEMPLATED_TEMPLATE_CACHE_CHECK_MTIME`` settings, and it is
+    disabled by default.
+    """
+
+    def __init__(self):
+        super(TemplateCache, self).__init__(0)
+
+    @property
+    def max_size(self):
+        return app_settings.TEMPLATE_CACHE_SIZE
+
+    @property
+    def timeout(self):
+        return app_settings.TEMPLATE_CACHE_TIMEOUT
+
+    def get_template(self, template_name, using=None):
+        """
+        Load the template from the cache or using the template loaders.
+
+        Arguments
+        ---------
+        template_name : str
+            |template_name|
+
+        Keyword Arguments
+        -----------------
+        using : str
+            The name of the template engine to use.
+        """
+        if not self.max_size:
+            return _get_template(template_name, using)
+        key = (template_name, using)
+        check_mtime = app_settings.TEMPLATE_CACHE_CHECK_MTIME
+        entry = self.get(key)
+        if entry is not None:
+            template, mtime = entry
+            if not check_mtime or _get_mtime(template) == mtime:
+                return template
+            # The statistics should reflect that the template is reloaded.
+            self.hits -= 1
+            self.misses += 1
+        template = _get_template(template_name, using)
+        self.set(key, (template, _get_mtime(template) if check_mtime else None))
+        return template
+
+
+class RenderCache(LRUCache):
+    """
+    Cache of the rendered email parts.
+
+    The parts are cached by template name, current language and context. It
+    is configured with the ``MAIL_TEMPLATED_RENDER_CACHE_*`` settings, and
+    it is disabled by default. The in-process cache is used unless the
+    ``MAIL_TEMPLATED_RENDER_CACHE_ALIAS`` setting specifies one of the Django
+    caches.
+    """
+
+    def __init__(self):
+        super(RenderCache, self).__init__(0)
+
+    @property
+    def max_size(self):
+        return app_settings.RENDER_CACHE_SIZE
+
+    @property
+    def timeout(self):
+        return app_settings.RENDER_CACHE_TIMEOUT
+
+    @property
+    def enabled(self):
+        return bool(self.max_size or app_settings.RENDER_CACHE_ALIAS)
+
+    def make_key(self, template_name, context):
+        """
+        Make the cache key with the function specified by the
+        ``MAIL_TEMPLATED_RENDER_CACHE_KEY_FUNCTION`` setting.
+
+        Returns ``None`` if the context can not be cached.
+        """
+        key_function = get_callable(app_settings.RENDER_CACHE_KEY_FUNCTION)
+        return key_function(template_name, context)
+
+    def get(self, key, default=None):
+        alias = app_settings.RENDER_CACHE_ALIAS
+        if alias is None:
+            return super(RenderCache, self).get(key, default)
+        value = get_cache(alias).get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        alias = app_settings.RENDER_CACHE_ALIAS
+        if alias is None:
+            return super(RenderCache, self).set(key, value)
+        if self.timeout is None:
+            get_cache(alias).set(key, value)
+        else:
+            get_cache(alias).set(key, value, self.timeout)
+
+
+def make_render_key(template_name, context):
+    """
+    Make the render cache key from the template name, current language and
+    JSON representation of the context. The strings marked as safe are tagged
+    in the key, because they are rendered without escaping.
+
+    Returns ``None`` if the context is not JSON serializable, so that such
+    messages are not cached. Specify your own function in the
+    ``MAIL_TEMPLATED_RENDER_CACHE_KEY_FUNCTION`` setting if you need to cache
+    the messages with other values in the context, for example with model
+    instances.
+    """
+    try:
+        data = json.dumps([template_name, translation.get_language(),
+                           _tag_safe(context)], sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return 'mail_templated:render:' + hashlib.sha1(
+        data.encode('utf-8')).hexdigest()
+
+
+def _tag_safe(value):
+    """
+    Replace the safe strings in the nested dicts and lists with the tagged
+    ones so that they do not share the key with the plain strings.
+    """
+    if isinstance(value, SafeData):
+        return {'\x00safe': '%s' % (value,)}
+    if isinstance(value, dict):
+        return dict((key, _tag_safe(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_tag_safe(item) for item in value]
+    return value
+
+
+def _get_template(template_name, using=None):
+    # The `using` parameter is supported since Django 1.8.
+    if using is None:
+        return get_template(template_name)
+    return get_template(template_name, using=using)
+
+
+def _get_mtime(template):
+    """
+    Get modification time of the template file, or ``None`` if unknown.
+    """
+    # The backend templates wrap the Django templates since Django 1.8.
+    origin = (getattr(template, 'origin', None) or
+              getattr(getattr(template, 'template', None), 'origin', None))
+    try:
+        return os.path.getmtime(origin.name)
+    except (AttributeError, TypeError, OSError):
+        return None
+
+
+template_cache = TemplateCache()
+render_cache = RenderCache()
+
+
+def _clear_caches(**kwargs):
+    setting = kwargs['setting']
+    if setting in ('TEMPLATES', 'TEMPLATE_DIRS', 'TEMPLATE_LOADERS',
+                   'INSTALLED_APPS') or setting.startswith(
+                       'MAIL_TEMPLATED_TEMPLATE_CACHE_'):
+        template_cache.clear()
+    # The rendered html is cached after the processing.
+    if setting.startswith('MAIL_TEMPLATED_RENDER_CACHE_') or setting in (
+            'MAIL_TEMPLATED_HTML_PROCESSORS', 'MAIL_TEMPLATED_CSS_INLINER'):
+        render_cache.clear()
+
+
+setting_changed.connect(_clear_caches)
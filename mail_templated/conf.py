@@ -1,11 +1,20 @@
 import importlib
 
 from django.conf import settings
+from django.test.signals import setting_changed
 from django.utils.functional import empty, LazyObject
 
+try:
+    from django.utils.module_loading import import_string
+except ImportError:
+    # Django < 1.7
+    from django.utils.module_loading import import_by_path as import_string
+
 
 SETTINGS_MODULE = 'mail_templated.default_settings'
 
+PREFIX = 'MAIL_TEMPLATED_'
+
 
 class AppSettings(object):
 
@@ -45,13 +54,51 @@ class LazyAppSettings(LazyObject):
         }
 
     def __getattr__(self, name):
-        full_name = 'MAIL_TEMPLATED_' + name
-        value = getattr(settings, full_name, empty)
-        if value is not empty:
-            return value
-        if self._wrapped is empty:
-            self._setup()
-        return getattr(self._wrapped, name)
+        """
+        Get the setting value and cache it in the instance dict, so that this
+        method is not called again for the same setting.
+
+        The cache is cleared on the ``setting_changed`` signal which is sent
+        by ``override_settings()``.
+        """
+        value = getattr(settings, PREFIX + name, empty)
+        if value is empty:
+            if self._wrapped is empty:
+                self._setup()
+            value = getattr(self._wrapped, name)
+        self.__dict__[name] = value
+        return value
+
+    def clear_cache(self, name=None):
+        """
+        Clear the cached value of the setting, or of all settings if the
+        ``name`` is not specified.
+        """
+        if name is not None:
+            self.__dict__.pop(name, None)
+            return
+        for key in list(self.__dict__):
+            if key.isupper():
+                del self.__dict__[key]
 
 
 app_settings = LazyAppSettings()
+
+
+def _clear_cache(**kwargs):
+    setting = kwargs['setting']
+    if setting.startswith(PREFIX):
+        app_settings.clear_cache(setting[len(PREFIX):])
+
+
+setting_changed.connect(_clear_cache)
+
+
+def get_callable(value):
+    """
+    Get a callable from the setting value which is either a callable or a
+    dotted path to it.
+    """
+    if value is None or callable(value):
+        return value
+    return import_string(value)
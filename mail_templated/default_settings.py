@@ -6,3 +6,120 @@ TAG_FORMAT = '###{bound}_{block}###'
 # The template for tag variables that is used to generate the context
 # variables for storing the actual email part tags.
 TAG_VAR_FORMAT = 'TAG_{BOUND}_{BLOCK}'
+
+# The template for the context variables that are used to skip rendering of
+# the email parts that are not requested. See ``EmailMessage.render()``.
+SKIP_VAR_FORMAT = 'SKIP_{BLOCK}'
+
+# The number of messages passed to the email backend at once by the mass
+# mailing helpers such as ``send_mass_mail()``.
+MASS_MAIL_CHUNK_SIZE = 100
+
+# The number of objects fetched from the database at once by
+# ``iter_queryset_messages()``.
+QUERYSET_BATCH_SIZE = 100
+
+# The number of messages sent to a worker process at once by the parallel
+# renderer.
+PARALLEL_CHUNK_SIZE = 10
+
+# The maximum number of compiled templates cached by ``EmailMessage``. The
+# cache is disabled if it is ``0``.
+TEMPLATE_CACHE_SIZE = 0
+
+# The number of seconds after that the cached template is loaded again, or
+# ``None`` to cache forever.
+TEMPLATE_CACHE_TIMEOUT = None
+
+# If ``True``, the cached template is loaded again when it's file is modified.
+# Useful for development. Only the file of the template itself is checked,
+# not the files of the parent templates.
+TEMPLATE_CACHE_CHECK_MTIME = False
+
+# The maximum number of rendered messages cached in the process memory. The
+# messages with identical template, language and context are rendered only
+# once. The cache is disabled if it is ``0``.
+RENDER_CACHE_SIZE = 0
+
+# The name of the Django cache to use for the rendered messages instead of the
+# process memory, i.e. ``'default'``. This also enables the cache.
+RENDER_CACHE_ALIAS = None
+
+# The number of seconds to cache the rendered messages, or ``None`` to cache
+# forever (or the default timeout of the Django cache).
+RENDER_CACHE_TIMEOUT = None
+
+# The function that makes the render cache key from the template name and the
+# context, or a dotted path to it. It should return ``None`` for the messages
+# that should not be cached.
+RENDER_CACHE_KEY_FUNCTION = 'mail_templated.cache.make_render_key'
+
+# The functions that transform the rendered html part, or dotted paths to
+# them, i.e. ``['mail_templated.processors.inline_css',
+# 'mail_templated.processors.minify_html']``. They are applied in order.
+HTML_PROCESSORS = ()
+
+# The maximum number of processed html parts cached in the process memory.
+# The identical html is processed only once. The cache is disabled if it is
+# ``0``.
+HTML_PROCESSORS_CACHE_SIZE = 100
+
+# The function that inlines the CSS rules into the html, or a dotted path to
+# it, i.e. ``'premailer.transform'``. It is used by the
+# ``mail_templated.processors.inline_css`` processor.
+CSS_INLINER = None
+
+# If ``True``, the plain text part is generated from the html part for the
+# templates without the ``body`` block, instead of sending html-only
+# messages. It may also be a function that converts html to text, or a dotted
+# path to it.
+PLAIN_TEXT_FROM_HTML = False
+
+# The maximum number of generated plain text parts cached in the process
+# memory. The cache is disabled if it is ``0``.
+PLAIN_TEXT_CACHE_SIZE = 100
+
+# The maximum number of encoded attachments cached in the process memory. The
+# identical attachments of different messages are encoded only once. The cache
+# is disabled if it is ``0``.
+ATTACHMENT_CACHE_SIZE = 0
+
+# The maximum number of MIME structures cached for reuse. The messages with the
+# same alternative types and attachments reuse the multipart containers and
+# the encoded attachments of the first such message. The cache is disabled if
+# it is ``0``.
+MIME_SKELETON_CACHE_SIZE = 0
+
+# The maximum number of messages processed at a time by the asynchronous mass
+# mailing helpers.
+ASYNC_CONCURRENCY = 10
+
+# The default parameters of the threaded dispatcher: the number of worker
+# threads, the maximum number of messages in the queue, the maximum number of
+# retries on temporary errors, and the delay before the first retry in
+# seconds.
+DISPATCH_WORKERS = 4
+DISPATCH_QUEUE_SIZE = 100
+DISPATCH_RETRIES = 3
+DISPATCH_RETRY_DELAY = 1.0
+
+# The default parameters of the rate limited scheduler: the maximum number of
+# messages per second in total and for each recipient domain (``None`` means
+# unlimited), the number of messages that can be sent at once before the
+# limits apply, and the number of messages after that the connection is
+# reopened (``None`` means never).
+THROTTLE_RATE = None
+THROTTLE_DOMAIN_RATE = None
+THROTTLE_BURST = 1
+THROTTLE_MESSAGES_PER_CONNECTION = None
+
+# The function that receives the timings of the message processing stages, or
+# a dotted path to it. See the ``mail_templated.signals`` module for details.
+METRICS_CALLBACK = None
+
+# The email templates to compile on the application start: the names or glob
+# patterns like ``'email/*.html'``, or ``'auto'`` for all templates that extend
+# ``mail_templated/base.tpl``. The compiled templates are stored in the
+# template cache (see ``TEMPLATE_CACHE_SIZE``) and in the cached template
+# loader of Django if it is enabled.
+WARMUP_TEMPLATES = ()
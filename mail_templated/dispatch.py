@@ -0,0 +1,250 @@
+"""
+.. module:: mail_templated.dispatch
+   :synopsis: Concurrent sending of email messages in a pool of threads.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import smtplib
+import threading
+import time
+
+from django.core import mail
+
+from .conf import app_settings
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+# The marker that tells a worker thread to stop.
+_STOP = object()
+
+
+def is_transient_error(exc):
+    """
+    Check if the error is temporary and sending should be retried.
+
+    These are the connection errors and the SMTP errors with 4xx codes.
+    """
+    if isinstance(exc, (smtplib.SMTPServerDisconnected,
+                        smtplib.SMTPConnectError)):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(
+            400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPException):
+        return False
+    return isinstance(exc, (IOError, OSError))
+
+
+class Dispatcher(object):
+    """
+    Send email messages concurrently in a pool of threads.
+
+    Each worker thread holds it's own long-lived connection to the email
+    server and pulls the messages from a bounded queue. Use it when the
+    sending is slower than the rendering, for example with a remote SMTP
+    server.
+
+    The dispatcher can be used as a context manager that starts the workers
+    on enter and waits for all messages to be sent on exit:
+
+    .. code-block:: python
+
+        with Dispatcher(workers=8) as dispatcher:
+            for message in iter_rendered_messages(...):
+                dispatcher.submit(message)
+        print(dispatcher.stats())
+
+    Keyword Arguments
+    -----------------
+    workers : int
+        The number of worker threads. Defaults to the
+        ``MAIL_TEMPLATED_DISPATCH_WORKERS`` setting.
+    queue_size : int
+        The maximum number of messages waiting in the queue. The
+        :meth:`submit()` method blocks when the queue is full. Defaults to the
+        ``MAIL_TEMPLATED_DISPATCH_QUEUE_SIZE`` setting.
+    retries : int
+        The maximum number of retries on :func:`transient errors
+        <is_transient_error>`. Defaults to the
+        ``MAIL_TEMPLATED_DISPATCH_RETRIES`` setting.
+    retry_delay : float
+        The delay before the first retry in seconds. It is doubled for each
+        next retry. Defaults to the ``MAIL_TEMPLATED_DISPATCH_RETRY_DELAY``
+        setting.
+    get_connection : callable
+        The function that creates a connection for a worker thread. Defaults
+        to :func:`django.core.mail.get_connection`.
+    """
+
+    def __init__(self, workers=None, queue_size=None, retries=None,
+                 retry_delay=None, get_connection=None):
+        self.workers = workers or app_settings.DISPATCH_WORKERS
+        self.retries = (app_settings.DISPATCH_RETRIES if retries is None
+                        else retries)
+        self.retry_delay = (app_settings.DISPATCH_RETRY_DELAY
+                            if retry_delay is None else retry_delay)
+        self.get_connection = get_connection or mail.get_connection
+        self.queue = queue.Queue(queue_size or
+                                 app_settings.DISPATCH_QUEUE_SIZE)
+        #: The list of ``(message, exception)`` pairs for failed messages.
+        self.errors = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+        self._threads = []
+        self._started = self._finished = None
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        self._started = time.time()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='mail-templated-dispatcher-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, message):
+        """
+        Put the message to the queue. Blocks while the queue is full.
+
+        The message is rendered by the worker thread if it is not rendered
+        yet.
+        """
+        self.queue.put(message)
+
+    def join(self):
+        """
+        Wait until all submitted messages are processed and stop the workers.
+
+        Returns
+        -------
+        dict
+            See :meth:`stats()`.
+        """
+        for thread in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._finished = time.time()
+        return self.stats()
+
+    def stats(self):
+        """
+        Get the aggregate statistics.
+
+        Returns
+        -------
+        dict
+            The numbers of ``sent``, ``failed`` and ``retried`` messages,
+            ``elapsed`` time in seconds, and ``throughput`` in messages per
+            second.
+        """
+        with self._lock:
+            elapsed = 0
+            if self._started is not None:
+                elapsed = (self._finished or time.time()) - self._started
+            return {
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'elapsed': elapsed,
+                'throughput': self.sent / elapsed if elapsed else 0.0,
+            }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+    def _work(self):
+        connection = self.get_connection()
+        try:
+            connection.open()
+        except Exception:
+            # The worker should keep consuming the queue. The sending will
+            # retry to connect, and the message is recorded as failed if
+            # it is not possible.
+            pass
+        try:
+            while True:
+                message = self.queue.get()
+                if message is _STOP:
+                    break
+                self._send(connection, message)
+        finally:
+            connection.close()
+
+    def _send(self, connection, message):
+        attempt = 0
+        while True:
+            try:
+                if not getattr(message, 'is_rendered', True):
+                    message.render()
+                sent = connection.send_messages([message]) or 0
+            except Exception as exc:
+                if attempt < self.retries and is_transient_error(exc):
+                    attempt += 1
+                    with self._lock:
+                        self.retried += 1
+                    self._reconnect(connection, attempt)
+                    continue
+                with self._lock:
+                    self.failed += 1
+                    self.errors.append((message, exc))
+                return
+            with self._lock:
+                if sent:
+                    self.sent += sent
+                else:
+                    self.failed += 1
+            return
+
+    def _reconnect(self, connection, attempt):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        time.sleep(self.retry_delay * 2 ** (attempt - 1))
+        try:
+            connection.open()
+        except Exception:
+            # The next attempt will fail and retry again if appropriate.
+            pass
+
+
+def dispatch(messages, **kwargs):
+    """
+    Send the messages with a :class:`Dispatcher`.
+
+    Arguments
+    ---------
+    messages : iterable
+        Email messages to send. It may be a generator, it is consumed lazily.
+
+    Keyword arguments are passed to the :class:`Dispatcher` constructor.
+
+    Returns
+    -------
+    dict
+        See :meth:`Dispatcher.stats()`.
+    """
+    dispatcher = Dispatcher(**kwargs)
+    with dispatcher:
+        for message in messages:
+            dispatcher.submit(message)
+    return dispatcher.stats()
@@ -0,0 +1,110 @@
+"""
+.. module:: mail_templated.i18n
+   :synopsis: Mass mailing to recipients with different languages.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+from collections import OrderedDict
+
+from django.core import mail
+from django.utils import translation
+
+from .personalize import iter_personalized_messages
+from .utils import iter_rendered_messages, send_messages
+
+
+def iter_localized_messages(template_name, datatuple, from_email=None,
+                            shared_context=None, variables=None, **kwargs):
+    """
+    Render a message for each recipient list in it's own language.
+
+    The recipients are grouped by language, so the messages in the same
+    language are rendered one after another. The language is active only
+    while a message is rendered, and the language of the consumer is
+    restored before the message is yielded. The ``datatuple`` is consumed at
+    once to group the items, but the messages are still rendered lazily.
+
+    If the ``shared_context`` is specified, the contexts of the ``datatuple``
+    are the values of the personalised variables, and the template is
+    rendered only once per language with the shared context, like with
+    :func:`~mail_templated.iter_personalized_messages()`. This way the
+    translated static content is rendered once per language instead of once
+    per recipient.
+
+    The rendered messages with identical context are also cached per language
+    if the :ref:`render cache <render_cache>` is enabled.
+
+    Arguments
+    ---------
+    template_name : str
+        |template_name|
+    datatuple : iterable
+        An iterable of ``(context, recipient_list, language)`` tuples. The
+        current language is used if the ``language`` is ``None``.
+
+    Keyword Arguments
+    -----------------
+    from_email : str
+        |from_email|
+    shared_context : dict
+        The context shared by all recipients.
+    variables : iterable
+        The names of the personalised variables. Defaults to the keys of the
+        first personal context. Used only with the ``shared_context``.
+
+    Any other keyword arguments are passed to the
+    :class:`~mail_templated.EmailMessage` constructor of every message.
+
+    Yields
+    ------
+    EmailMessage
+        Rendered and cleaned message.
+    """
+    current_language = translation.get_language()
+    groups = OrderedDict()
+    for context, recipient_list, language in datatuple:
+        groups.setdefault(language or current_language, []).append(
+            (context, recipient_list))
+    for language, items in groups.items():
+        if shared_context is None:
+            messages = iter_rendered_messages(template_name, items,
+                                              from_email, **kwargs)
+        else:
+            messages = iter_personalized_messages(
+                template_name, shared_context, items, from_email, variables,
+                **kwargs)
+        while True:
+            # Don't leak the language to the consumer between the messages.
+            with translation.override(language):
+                message = next(messages, None)
+            if message is None:
+                break
+            yield message
+
+
+def send_localized_mail(template_name, datatuple, from_email=None,
+                        fail_silently=False, auth_user=None,
+                        auth_password=None, connection=None, chunk_size=None,
+                        **kwargs):
+    """
+    Send a message to each recipient list in it's own language.
+
+    This is a combination of :func:`iter_localized_messages()` and
+    :func:`~mail_templated.send_messages()`. The arguments are the same as
+    for :func:`~mail_templated.send_mass_mail()`, except of the
+    ``datatuple`` that contains ``(context, recipient_list, language)``
+    tuples. The ``shared_context`` and ``variables`` arguments are also
+    supported.
+
+    Returns
+    -------
+    int
+        The number of successfully delivered messages.
+    """
+    connection = connection or mail.get_connection(username=auth_user,
+                                                   password=auth_password,
+                                                   fail_silently=fail_silently)
+    messages = iter_localized_messages(template_name, datatuple, from_email,
+                                       connection=connection, **kwargs)
+    return send_messages(messages, connection, chunk_size)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...warmup import compile_templates, resolve_template_names
+
+
+class Command(BaseCommand):
+    help = ('Compile the email templates and report the compile times. '
+            'All templates that extend "mail_templated/base.tpl" are checked '
+            'by default.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('patterns', nargs='*',
+                            help='Template names or glob patterns.')
+
+    def handle(self, *args, **options):
+        patterns = options.get('patterns') or args or 'auto'
+        result = compile_templates(resolve_template_names(patterns))
+        errors = 0
+        for name, seconds, error in result:
+            if error is None:
+                self.stdout.write('%8.2f ms  %s' % (seconds * 1000, name))
+            else:
+                errors += 1
+                self.stdout.write('   ERROR    %s: %s' % (name, error))
+        self.stdout.write('%d templates checked, %d errors.' % (
+            len(result), errors))
+        if errors:
+            raise CommandError('Some email templates failed to compile.')
@@ -5,12 +5,24 @@
 .. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
 """
 
+try:
+    from collections import ChainMap
+except ImportError:
+    # Python 2
+    ChainMap = None
+
 from django.core import mail
-from django.template import Context
-from django.template.loader import get_template
+from django.template import Context, Template
 from django.utils.safestring import mark_safe
 
+from .attachments import FileContent, attachment_cache, file_attachment
+from .cache import render_cache, template_cache
+from . import payload, signals
 from .conf import app_settings
+from .mime import skeleton_cache
+from .parser import BLOCKS, get_parser
+from .processors import process_html
+from .text import get_plain_text
 
 
 class EmailMessage(mail.EmailMultiAlternatives):
@@ -136,21 +148,38 @@ class EmailMessage(mail.EmailMultiAlternatives):
             cls._extra_context_fingerprint = (tag_var_format, tag_format)
         return cls._extra_context
 
-    def load_template(self, template_name=None):
+    def load_template(self, template_name=None, using=None):
         """
         Load a template by it's name using the current
         :ref:`template loaders <django:template-loaders>`.
 
+        The compiled templates are cached if the
+        ``MAIL_TEMPLATED_TEMPLATE_CACHE_SIZE`` setting is not zero. See
+        :ref:`template_cache` for details.
+
         Arguments
         ---------
         template_name : str
             |template_name| If not specified then the
             :attr:`~mail_templated.EmailMessage.template_name` property is
             used.
-        """
-        self.template = get_template(template_name or self.template_name)
 
-    def render(self, context=None, clean=False):
+        Keyword Arguments
+        -----------------
+        using : str
+            The name of the template engine to use (Django >= 1.8).
+
+        The loading time is reported to the :ref:`instrumentation` hooks.
+        """
+        instrument = signals.is_enabled()
+        if instrument:
+            start = signals.start()
+        self.template = template_cache.get_template(
+            template_name or self.template_name, using)
+        if instrument:
+            signals.emit('load_template', self, start)
+
+    def render(self, context=None, clean=False, parts=None):
         """
         Render email with provided context
 
@@ -166,29 +195,64 @@ class EmailMessage(mail.EmailMultiAlternatives):
         clean : bool
             If ``True``, remove any template specific properties from the
             message object. Default is ``False``.
+        parts : tuple
+            The names of the email parts to render, i.e. ``'subject'``,
+            ``'body'`` and ``'html'``. The rest parts are not rendered at all
+            if the template extends `mail_templated/base.tpl`. The message is
+            not considered rendered in this case, and it will be rendered
+            again on sending. The html part is attached as alternative if the
+            body part is not requested, and it is replaced on the next
+            rendering. Default is all parts.
+
+        The rendered parts are taken from the :ref:`render cache
+        <render_cache>` if it is enabled.
+        """
+        parts = set(BLOCKS if parts is None else parts)
+        if parts.difference(BLOCKS):
+            raise ValueError('Unknown email parts: %s' % ', '.join(
+                sorted(parts.difference(BLOCKS))))
+        is_partial = len(parts) < len(BLOCKS)
+        content = cache_key = None
+        if not is_partial and self.template_name and render_cache.enabled:
+            cache_key = render_cache.make_key(self.template_name,
+                                              context or self.context)
+            if cache_key is not None:
+                content = render_cache.get(cache_key)
+        if content is None:
+            content = self._render_parts(context, parts)
+            if cache_key is not None:
+                render_cache.set(cache_key, content)
+        # Remove the html attached by the previous partial rendering.
+        partial_html = self.__dict__.pop('_partial_html', None)
+        if partial_html is not None and partial_html in self.alternatives:
+            self.alternatives.remove(partial_html)
+        count = len(self.alternatives)
+        self._set_content(content, parts)
+        if not is_partial:
+            self._is_rendered = True
+        elif len(self.alternatives) > count:
+            self._partial_html = self.alternatives[-1]
+        if clean:
+            self.clean()
+
+    def _set_content(self, content, parts=BLOCKS):
+        """
+        Set the rendered email parts to the message.
         """
-        # Load template if it is not loaded yet.
-        if not self.template:
-            self.load_template(self.template_name)
-        # The signature of the `render()` method was changed in Django 1.7.
-        # https://docs.djangoproject.com/en/1.8/ref/templates/upgrading/#get-template-and-select-template
-        if hasattr(self.template, 'template'):
-            context = (context or self.context).copy()
-        else:
-            context = Context(context or self.context)
-        # Add tag strings to the context.
-        context.update(self.extra_context)
-        result = self.template.render(context)
         # Don't overwrite default value with empty one.
-        subject = self._get_block(result, 'subject')
-        if subject:
-            self.subject = self._get_block(result, 'subject')
-        body = self._get_block(result, 'body')
+        if 'subject' in parts and content['subject']:
+            self.subject = content['subject']
+        body = content['body'] if 'body' in parts else None
         is_html_body = False
         # The html block is optional, and it also may be set manually.
-        html = self._get_block(result, 'html')
+        html = content['html'] if 'html' in parts else None
         if html:
-            if not body:
+            if not body and 'body' in parts and \
+                    app_settings.PLAIN_TEXT_FROM_HTML:
+                # Generate the plain text part from the html.
+                body = get_plain_text(html)
+                self.attach_alternative(html, 'text/html')
+            elif not body and 'body' in parts:
                 # This is an html message without plain text part.
                 body = html
                 is_html_body = True
@@ -200,9 +264,117 @@ class EmailMessage(mail.EmailMultiAlternatives):
             self.body = body
             if is_html_body:
                 self.content_subtype = 'html'
-        self._is_rendered = True
-        if clean:
-            self.clean()
+
+    def _render_parts(self, context, parts):
+        """
+        Render the template and extract the email parts.
+        """
+        # Load template if it is not loaded yet.
+        if not self.template:
+            self.load_template(self.template_name)
+        render, context = self._make_context(context or self.context)
+        # Add tag strings to the context.
+        context.update(self.extra_context)
+        if len(parts) < len(BLOCKS):
+            # Skip the blocks that are not requested.
+            skip_var_format = str(app_settings.SKIP_VAR_FORMAT)
+            context.update(dict(
+                (skip_var_format.format(BLOCK=block.upper()), True)
+                for block in BLOCKS if block not in parts))
+        instrument = signals.is_enabled()
+        if instrument:
+            start = signals.start()
+        result = render(context)
+        if instrument:
+            signals.emit('render', self, start, len(result))
+            start = signals.start()
+        content = get_parser().parse(result)
+        if instrument:
+            signals.emit('extract', self, start,
+                         sum(len(part) for part in content.values() if part))
+        if content['html'] and app_settings.HTML_PROCESSORS:
+            if instrument:
+                start = signals.start()
+            content['html'] = process_html(content['html'])
+            if instrument:
+                signals.emit('process', self, start, len(content['html']))
+        return content
+
+    def _make_context(self, context):
+        """
+        Get the render function and the context object for the template.
+
+        The extra variables are pushed over the caller's dict as separate
+        layers of the :class:`~django.template.Context`, so that the dict is
+        neither copied nor modified. The caller's dict is wrapped into a
+        :class:`~collections.ChainMap` with an empty dict in front of it,
+        because some tags (e.g. ``{% cycle ... as name %}``) write the
+        variables to the layer where they are already defined.
+        """
+        template = self.template
+        if ChainMap is None:
+            context = context.copy()
+        else:
+            context = ChainMap({}, context)
+        # The signature of the `render()` method was changed in Django 1.7.
+        # https://docs.djangoproject.com/en/1.8/ref/templates/upgrading/#get-template-and-select-template
+        if not hasattr(template, 'template'):
+            return template.render, Context(context)
+        if isinstance(template.template, Template):
+            # The backend wrapper accepts only a plain dict, so render the
+            # wrapped Django template directly the same way as the wrapper
+            # does.
+            engine = getattr(getattr(template, 'backend', None), 'engine', None)
+            return template.template.render, Context(
+                context, autoescape=getattr(engine, 'autoescape', True))
+        # Other template backends.
+        return template.render, dict(context)
+
+    def attach_file(self, path, mimetype=None, lazy=False):
+        """
+        Attach a file from the filesystem.
+
+        Arguments
+        ---------
+        path : str
+            The path to the file.
+
+        Keyword Arguments
+        -----------------
+        mimetype : str
+            The mimetype of the file. It is guessed from the file name if not
+            specified.
+        lazy : bool
+            If ``True``, the file is read only when the message is built for
+            sending, and only the path is serialized. See
+            :class:`~mail_templated.attachments.FileContent`. Default is
+            ``False``.
+        """
+        if not lazy:
+            return super(EmailMessage, self).attach_file(path, mimetype)
+        self.attach(*file_attachment(path, mimetype))
+
+    def _create_message(self, msg):
+        if not skeleton_cache.max_size:
+            return super(EmailMessage, self)._create_message(msg)
+        return skeleton_cache.create_message(
+            self, msg, super(EmailMessage, self)._create_message)
+
+    def _create_attachment(self, filename, content, mimetype=None):
+        if attachment_cache.max_size:
+            key = attachment_cache.make_key(filename, content, mimetype,
+                                            self.encoding)
+            if key is not None:
+                return attachment_cache.get_attachment(
+                    key, lambda: self._encode_attachment(filename, content,
+                                                         mimetype))
+        return self._encode_attachment(filename, content, mimetype)
+
+    def _encode_attachment(self, filename, content, mimetype):
+        if isinstance(content, FileContent):
+            content, mimetype = content.read(mimetype)
+        return super(EmailMessage, self)._create_attachment(
+            filename, content, mimetype)
 
     def send(self, *args, **kwargs):
         """
@@ -224,7 +396,24 @@ class EmailMessage(mail.EmailMultiAlternatives):
             self.render()
         if clean:
             self.clean()
-        return super(EmailMessage, self).send(*args, **kwargs)
+        if not signals.is_enabled():
+            return super(EmailMessage, self).send(*args, **kwargs)
+        start = signals.start()
+        result = super(EmailMessage, self).send(*args, **kwargs)
+        signals.emit('send', self, start)
+        return result
+
+    def asend(self, fail_silently=False, clean=False, executor=None):
+        """
+        Asynchronous version of the :meth:`send()` method.
+
+        Returns a coroutine. The rendering and the blocking email backends are
+        offloaded to the ``executor`` (the default executor of the event loop
+        by default). See :mod:`mail_templated.aio` for details. Requires
+        Python 3.5 or later.
+        """
+        from .aio import asend_message
+        return asend_message(self, fail_silently, clean, executor)
 
     def clean(self):
         """
@@ -246,13 +435,83 @@ class EmailMessage(mail.EmailMultiAlternatives):
         del self.template_name
 
 
+    def to_payload(self, deferred=False):
+        """
+        Serialize the message to a compact JSON compatible dict.
+
+        Unlike pickling, the payload contains only the data that is needed to
+        send the message: the rendered parts, alternatives, headers,
+        recipients and attachments. The message is rendered if it is not
+        rendered yet. Binary attachments are encoded with base64. Use
+        :meth:`from_payload()` to restore the message.
+
+        With ``deferred=True`` the message is not rendered. The payload
+        contains the template name, the context and the current language
+        instead, and the message is rendered by :meth:`from_payload()`. This
+        is cheaper for large messages with small context. The model instances
+        in the context are replaced with references to their primary keys and
+        fetched again on restoring. Other context values should be JSON
+        compatible.
+
+        Keyword Arguments
+        -----------------
+        deferred : bool
+            If ``True``, serialize the template name and context instead of
+            the rendered content. Default is ``False``.
+
+        Returns
+        -------
+        dict
+            The payload that can be serialized with :mod:`json`, msgpack and
+            so on.
+        """
+        if not deferred and not self._is_rendered:
+            self.render()
+        return payload.to_payload(self, deferred)
+
+    @classmethod
+    def from_payload(cls, data):
+        """
+        Restore the message serialized with :meth:`to_payload()`.
+
+        The message is ready for sending. The deferred payloads are rendered
+        in the language that was active on serialization.
+
+        Arguments
+        ---------
+        data : dict
+            The payload.
+
+        Returns
+        -------
+        EmailMessage
+            The rendered and cleaned message.
+        """
+        return payload.from_payload(cls, data)
+
+    @classmethod
+    def from_payloads(cls, data):
+        """
+        Restore many messages serialized with :meth:`to_payload()`.
+
+        This is the same as :meth:`from_payload()`, but the model instances
+        referenced by all deferred payloads are fetched with a single query
+        per model.
+
+        Arguments
+        ---------
+        data : iterable
+            The payloads.
+
+        Returns
+        -------
+        list
+            The rendered and cleaned messages.
+        """
+        return payload.from_payloads(cls, data)
+
     def _get_block(self, content, name):
-        marks = tuple(app_settings.TAG_FORMAT.format(block=name, bound=bound)
-                      for bound in ('start', 'end'))
-        start, end = (content.find(m) for m in marks)
-        if start == -1 or end == -1:
-            return
-        return content[start + len(marks[0]) : end].strip('\n\r')
+        return get_parser().get_block(content, name)
 
     def __getstate__(self):
         """
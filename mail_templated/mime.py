@@ -0,0 +1,184 @@
+"""
+.. module:: mail_templated.mime
+   :synopsis: Reuse of the MIME structure between similar messages.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import copy
+import random
+import sys
+
+from django.conf import settings
+from django.test.signals import setting_changed
+
+from .attachments import attachment_cache
+from .cache import LRUCache
+from .conf import app_settings
+
+
+def make_boundary():
+    """
+    Make a random MIME boundary in the same format as the :mod:`email`
+    package does.
+    """
+    return '=' * 15 + ('%%0%dd' % len(repr(sys.maxsize - 1))
+                       % random.randrange(sys.maxsize)) + '=='
+
+
+class MimeSkeleton(object):
+    """
+    The multipart containers and the encoded attachments shared by the
+    messages of the same shape.
+
+    The skeleton is made from the MIME tree of the first message. For the next
+    messages the containers are copied with their headers and the boundaries,
+    the attachments are copied as is, and only the body and the alternatives
+    are encoded again. The result is the same as the MIME tree built by
+    Django, except of the boundaries that are generated only once instead of
+    on every serialization.
+
+    Arguments
+    ---------
+    message : EmailMessage
+        The first message of this shape.
+    tree : email.message.Message
+        The MIME tree of the body, alternatives and attachments built by
+        Django for the message.
+    """
+
+    def __init__(self, message, tree):
+        self.mixed = self.alternative = None
+        self.attachments = []
+        if message.attachments:
+            self.mixed = self._make_container(tree)
+            parts = tree.get_payload()
+            self.attachments = [copy.deepcopy(part) for part in
+                                parts[len(parts) - len(message.attachments):]]
+            tree = parts[0]
+        if message.alternatives:
+            self.alternative = self._make_container(tree)
+
+    def create_message(self, message, body_msg):
+        """
+        Build the MIME tree for the message with the body part ``body_msg``.
+
+        Returns ``None`` if some part contains the boundary, so that the tree
+        should be built by Django.
+        """
+        msg = body_msg
+        parts = [body_msg]
+        if self.alternative is not None:
+            msg = self._copy_container(self.alternative)
+            if message.body:
+                msg.attach(body_msg)
+            for content, mimetype in message.alternatives:
+                part = message._create_mime_attachment(content, mimetype)
+                parts.append(part)
+                msg.attach(part)
+        if self.mixed is not None:
+            body_msg, msg = msg, self._copy_container(self.mixed)
+            if message.body or body_msg.is_multipart():
+                msg.attach(body_msg)
+            for attachment in self.attachments:
+                msg.attach(copy.deepcopy(attachment))
+        if self._has_collision(parts):
+            return None
+        return msg
+
+    def _make_container(self, container):
+        skeleton = copy.copy(container)
+        skeleton._headers = list(container._headers)
+        skeleton._payload = []
+        skeleton.set_boundary(make_boundary())
+        return skeleton
+
+    def _copy_container(self, container):
+        msg = copy.copy(container)
+        msg._headers = list(container._headers)
+        msg._payload = []
+        return msg
+
+    def _has_collision(self, parts):
+        boundaries = [container.get_boundary()
+                      for container in (self.mixed, self.alternative)
+                      if container is not None]
+        for part in parts:
+            payload = part.get_payload()
+            if any(boundary in payload for boundary in boundaries):
+                return True
+        return False
+
+
+class SkeletonCache(LRUCache):
+    """
+    Cache of the :class:`MimeSkeleton` objects by the shape of the messages.
+
+    It is configured with the ``MAIL_TEMPLATED_MIME_SKELETON_CACHE_SIZE``
+    setting, and it is disabled by default.
+    """
+
+    def __init__(self):
+        super(SkeletonCache, self).__init__(0)
+
+    @property
+    def max_size(self):
+        return app_settings.MIME_SKELETON_CACHE_SIZE
+
+    def make_key(self, message):
+        """
+        Make the key from the message parameters that define the MIME
+        structure, or ``None`` if the structure can not be reused.
+
+        The attachments are a part of the shape, so they should be identical.
+        """
+        if not message.alternatives and not message.attachments:
+            return None
+        encoding = message.encoding or settings.DEFAULT_CHARSET
+        attachments = []
+        for attachment in message.attachments:
+            try:
+                filename, content, mimetype = attachment
+            except (TypeError, ValueError):
+                # MIMEBase attachments.
+                return None
+            key = attachment_cache.make_key(filename, content, mimetype,
+                                            encoding)
+            if key is None:
+                return None
+            attachments.append(key)
+        return (message.__class__, encoding, message.alternative_subtype,
+                message.mixed_subtype, bool(message.body),
+                tuple(mimetype for _, mimetype in message.alternatives),
+                tuple(attachments))
+
+    def create_message(self, message, body_msg, create):
+        """
+        Build the MIME tree for the message using the skeleton of it's shape,
+        or with the ``create`` function if there is no skeleton yet.
+        """
+        key = self.make_key(message)
+        if key is None:
+            return create(body_msg)
+        skeleton = self.get(key)
+        if skeleton is None:
+            msg = create(body_msg)
+            self.set(key, MimeSkeleton(message, msg))
+            return msg
+        msg = skeleton.create_message(message, body_msg)
+        if msg is None:
+            return create(body_msg)
+        return msg
+
+
+skeleton_cache = SkeletonCache()
+
+
+def _clear_cache(**kwargs):
+    setting = kwargs['setting']
+    if setting == 'DEFAULT_CHARSET' or setting.startswith(
+            'MAIL_TEMPLATED_MIME_SKELETON_'):
+        skeleton_cache.clear()
+
+
+setting_changed.connect(_clear_cache)
@@ -0,0 +1,164 @@
+"""
+.. module:: mail_templated.parallel
+   :synopsis: Parallel rendering of email messages in a process pool.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template.loader import get_template
+
+from .conf import app_settings
+from .message import EmailMessage
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 without the `futures` package.
+    ProcessPoolExecutor = None
+
+
+# Templates preloaded by the worker process initializer.
+_templates = {}
+
+
+def render_parallel(messages, max_workers=None, chunk_size=None, clean=False,
+                    executor=None):
+    """
+    Render email messages in a pool of worker processes.
+
+    Template rendering is CPU bound and does not scale with threads, so this
+    function distributes the messages between several processes. The messages
+    are transferred to the workers and back using the same pickling support
+    that is described in the :ref:`serialization` section, and the templates
+    are loaded once per worker process.
+
+    Arguments
+    ---------
+    messages : iterable
+        Not rendered :class:`~mail_templated.EmailMessage` instances or
+        ``(template_name, context)`` pairs. The pairs are converted to the
+        messages with default parameters.
+
+    Keyword Arguments
+    -----------------
+    max_workers : int
+        The number of worker processes. Defaults to the number of CPUs.
+    chunk_size : int
+        The number of messages sent to a worker process at once. Defaults to
+        the ``MAIL_TEMPLATED_PARALLEL_CHUNK_SIZE`` setting.
+    clean : bool
+        If ``True``, remove any template specific properties from the
+        messages after rendering. Default is ``False``.
+    executor : concurrent.futures.ProcessPoolExecutor
+        The process pool created with :func:`create_executor()`. Pass it to
+        reuse the worker processes between the calls, for example when the
+        mailing is rendered in batches. A new pool is created and shut down
+        on every call if not specified, and the ``max_workers`` is ignored if
+        it is specified.
+
+    Returns
+    -------
+    list
+        The rendered messages in the same order. The connections of the
+        original messages are preserved, but otherwise these are new objects.
+    """
+    chunk_size = chunk_size or app_settings.PARALLEL_CHUNK_SIZE
+    messages = [m if isinstance(m, EmailMessage) else EmailMessage(*m)
+                for m in messages]
+    if not messages:
+        return []
+    connections = [m.connection for m in messages]
+    jobs = [(m.__class__, _get_state(m), clean) for m in messages]
+    shutdown = executor is None
+    if shutdown:
+        # The loaded templates are not pickled, so all templates are loaded
+        # by the workers.
+        executor = create_executor(max_workers, set(
+            m.template_name for m in messages
+            if getattr(m, 'template_name', None)))
+    try:
+        states = list(executor.map(_render, jobs, chunksize=chunk_size))
+    finally:
+        if shutdown:
+            executor.shutdown()
+    result = []
+    for (cls, _, _), state, connection in zip(jobs, states, connections):
+        message = _from_state(cls, state)
+        message.connection = connection
+        result.append(message)
+    return result
+
+
+def create_executor(max_workers=None, template_names=()):
+    """
+    Create a process pool for :func:`render_parallel()`.
+
+    Django is set up only once in every worker process, and the templates are
+    loaded only once per worker process too.
+
+    Keyword Arguments
+    -----------------
+    max_workers : int
+        The number of worker processes. Defaults to the number of CPUs.
+    template_names : iterable
+        The names of the templates to load on the start of the workers. Other
+        templates are loaded on first use.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+        The pool. Call it's ``shutdown()`` method when it is not needed
+        anymore.
+    """
+    if ProcessPoolExecutor is None:
+        raise ImproperlyConfigured('Parallel rendering requires Python 3 or '
+                                   'the "futures" package.')
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_worker,
+        initargs=(os.environ.get('DJANGO_SETTINGS_MODULE'),
+                  sorted(template_names)))
+
+
+def _get_state(message):
+    """
+    Get the picklable state of the message without the connection.
+    """
+    state = message.__getstate__()
+    state.pop('connection', None)
+    return state
+
+
+def _from_state(cls, state):
+    message = cls.__new__(cls)
+    message.__setstate__(state)
+    return message
+
+
+def _init_worker(settings_module, template_names):
+    """
+    Setup Django in the worker process and preload the templates.
+    """
+    if settings_module and not settings.configured:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    # Old Django versions do not need such initialisation.
+    if hasattr(django, 'setup'):
+        django.setup()
+    for template_name in template_names:
+        _templates[template_name] = get_template(template_name)
+
+
+def _render(job):
+    cls, state, clean = job
+    message = _from_state(cls, state)
+    template_name = getattr(message, 'template_name', None)
+    if message.template is None and template_name:
+        if template_name not in _templates:
+            _templates[template_name] = get_template(template_name)
+        message.template = _templates[template_name]
+    message.render(clean=clean)
+    return _get_state(message)
@@ -0,0 +1,93 @@
+"""
+.. module:: mail_templated.parser
+   :synopsis: Extraction of the email parts from the rendered template.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+from .conf import app_settings
+
+
+BLOCKS = ('subject', 'body', 'html')
+BOUNDS = ('start', 'end')
+
+
+class BlockParser(object):
+    """
+    Extract the email parts from the rendered template.
+
+    The tags are formatted only once on initialisation, so create a parser
+    once per tag format and reuse it, or use the :func:`get_parser()`
+    function which does this for you.
+
+    The tags are searched one after another starting from the position of the
+    previous tag. This way the whole document is scanned only once if the parts
+    go in the usual order (subject, body, html). If some tag is not found after
+    the previous one then it is searched from the beginning of the document.
+    """
+
+    def __init__(self, tag_format):
+        self.tag_format = tag_format
+        self.tags = tuple(
+            (block, tuple(tag_format.format(block=block, bound=bound)
+                          for bound in BOUNDS))
+            for block in BLOCKS)
+
+    def parse(self, content):
+        """
+        Extract all email parts from the rendered template.
+
+        Arguments
+        ---------
+        content : str
+            The rendered template.
+
+        Returns
+        -------
+        dict
+            The content of the parts by their names ("subject", "body",
+            "html"). The value is ``None`` if the part tags are not found.
+        """
+        parts = {}
+        pos = 0
+        for block, (start_tag, end_tag) in self.tags:
+            start = self._find(content, start_tag, pos)
+            if start == -1:
+                parts[block] = None
+                continue
+            start += len(start_tag)
+            end = self._find(content, end_tag, start)
+            if end == -1:
+                parts[block] = None
+                continue
+            parts[block] = content[start:end].strip('\n\r')
+            pos = end + len(end_tag)
+        return parts
+
+    def get_block(self, content, name):
+        """
+        Extract single email part from the rendered template.
+
+        Returns ``None`` if the part tags are not found.
+        """
+        return self.parse(content)[name]
+
+    def _find(self, content, tag, pos):
+        index = content.find(tag, pos)
+        if index == -1 and pos:
+            index = content.find(tag)
+        return index
+
+
+_parser = None
+
+
+def get_parser():
+    """
+    Get the parser for the current ``MAIL_TEMPLATED_TAG_FORMAT`` setting.
+    """
+    global _parser
+    tag_format = str(app_settings.TAG_FORMAT)
+    if _parser is None or _parser.tag_format != tag_format:
+        _parser = BlockParser(tag_format)
+    return _parser
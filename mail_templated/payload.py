@@ -0,0 +1,218 @@
+"""
+.. module:: mail_templated.payload
+   :synopsis: Compact serialization of email messages for queue transport.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import base64
+import email.message
+from email.mime.base import MIMEBase
+
+from django.db.models import Model
+from django.utils import translation
+
+from .attachments import FileContent
+
+try:
+    from django.apps import apps
+    get_model = apps.get_model
+except ImportError:
+    # Django < 1.7
+    from django.db.models import get_model
+
+PAYLOAD_VERSION = 1
+
+# The message attributes that are stored in the payload as is.
+FIELDS = ('subject', 'body', 'from_email', 'to', 'cc', 'bcc', 'reply_to',
+          'content_subtype', 'mixed_subtype')
+
+
+# The key that marks the references to model instances in the context.
+MODEL_KEY = '__model__'
+
+
+def to_payload(message, deferred=False):
+    """
+    Convert the message to a JSON compatible dict.
+
+    See :meth:`EmailMessage.to_payload()
+    <mail_templated.EmailMessage.to_payload>`.
+    """
+    payload = {'version': PAYLOAD_VERSION}
+    if deferred:
+        if message.is_rendered:
+            raise ValueError('The message is already rendered.')
+        if not message.template_name:
+            raise ValueError('The template name is required for deferred '
+                             'rendering.')
+        payload['template_name'] = message.template_name
+        payload['context'] = encode_context(message.context or {})
+        payload['language'] = translation.get_language()
+    for field in FIELDS:
+        if hasattr(message, field):
+            value = getattr(message, field)
+            payload[field] = list(value) if isinstance(value, (list, tuple)) \
+                else value
+    payload['headers'] = dict(message.extra_headers)
+    payload['alternatives'] = [list(alternative)
+                               for alternative in message.alternatives]
+    payload['attachments'] = [_attachment_to_payload(attachment)
+                              for attachment in message.attachments]
+    return payload
+
+
+def from_payloads(cls, payloads):
+    """
+    Create the messages from the payloads made by :func:`to_payload()`.
+
+    The model instances referenced by the deferred payloads are fetched with
+    a single query per model.
+
+    See :meth:`EmailMessage.from_payloads()
+    <mail_templated.EmailMessage.from_payloads>`.
+    """
+    payloads = list(payloads)
+    references = {}
+    for payload in payloads:
+        if 'context' in payload:
+            _collect_references(payload['context'], references)
+    instances = _fetch_instances(references)
+    return [_from_payload(cls, payload, instances) for payload in payloads]
+
+
+def from_payload(cls, payload):
+    """
+    Create the message from the payload made by :func:`to_payload()`.
+
+    See :meth:`EmailMessage.from_payload()
+    <mail_templated.EmailMessage.from_payload>`.
+    """
+    return from_payloads(cls, [payload])[0]
+
+
+def encode_context(value):
+    """
+    Convert the context to a JSON compatible form.
+
+    The model instances are replaced with references like
+    ``{'__model__': 'app_label.ModelName', 'pk': '1'}``. Dicts, lists and
+    tuples are converted recursively, other values are left as is.
+    """
+    if isinstance(value, Model):
+        opts = value._meta
+        return {MODEL_KEY: '%s.%s' % (opts.app_label, opts.object_name),
+                'pk': opts.pk.value_to_string(value)}
+    if isinstance(value, dict):
+        return dict((key, encode_context(item))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode_context(item) for item in value]
+    return value
+
+
+def decode_context(value, instances):
+    """
+    Replace the model references made by :func:`encode_context()` with the
+    instances from the ``instances`` dict keyed by ``(model, pk)`` pairs.
+    """
+    if isinstance(value, dict):
+        if MODEL_KEY in value:
+            return instances[value[MODEL_KEY], value['pk']]
+        return dict((key, decode_context(item, instances))
+                    for key, item in value.items())
+    if isinstance(value, list):
+        return [decode_context(item, instances) for item in value]
+    return value
+
+
+def _collect_references(value, references):
+    if isinstance(value, dict):
+        if MODEL_KEY in value:
+            references.setdefault(value[MODEL_KEY], set()).add(value['pk'])
+            return
+        for item in value.values():
+            _collect_references(item, references)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_references(item, references)
+
+
+def _fetch_instances(references):
+    instances = {}
+    for label, pks in references.items():
+        model = get_model(*label.split('.'))
+        pk_field = model._meta.pk
+        objects = model._default_manager.in_bulk(
+            [pk_field.to_python(pk) for pk in pks])
+        for pk in pks:
+            try:
+                instances[label, pk] = objects[pk_field.to_python(pk)]
+            except KeyError:
+                raise model.DoesNotExist(
+                    '%s with pk %r does not exist.' % (label, pk))
+    return instances
+
+
+def _from_payload(cls, payload, instances):
+    version = payload.get('version')
+    if version != PAYLOAD_VERSION:
+        raise ValueError('Unsupported payload version: %r' % (version,))
+    message = cls(headers=dict(payload['headers']),
+                  alternatives=[tuple(alternative) for alternative
+                                in payload['alternatives']])
+    for field in FIELDS:
+        if field in payload:
+            setattr(message, field, payload[field])
+    for attachment in payload['attachments']:
+        if 'mime' in attachment:
+            message.attach(email.message_from_string(
+                attachment['mime'], _class=_ParsedMIMEBase))
+            continue
+        if 'path' in attachment:
+            content = FileContent(attachment['path'])
+        else:
+            content = attachment['content']
+        if attachment.get('encoding') == 'base64':
+            content = base64.b64decode(content.encode('ascii'))
+        message.attach(attachment['filename'], content,
+                       attachment['mimetype'])
+    if 'template_name' in payload:
+        message.template_name = payload['template_name']
+        message.context = decode_context(payload['context'], instances)
+        language = payload.get('language')
+        if language is None:
+            message.render()
+        else:
+            with translation.override(language):
+                message.render()
+    else:
+        message._is_rendered = True
+    message.clean()
+    return message
+
+
+class _ParsedMIMEBase(MIMEBase):
+    """
+    MIMEBase that can be created by the email parser, because the
+    ``attach()`` method of the message accepts only the MIMEBase instances.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # The content type is set by the parser.
+        email.message.Message.__init__(self, *args, **kwargs)
+
+
+def _attachment_to_payload(attachment):
+    if isinstance(attachment, MIMEBase):
+        return {'mime': attachment.as_string()}
+    filename, content, mimetype = attachment
+    if isinstance(content, FileContent):
+        # The file is read by the consumer.
+        return {'filename': filename, 'mimetype': mimetype,
+                'path': content.path}
+    if isinstance(content, bytes):
+        return {'filename': filename, 'mimetype': mimetype,
+                'encoding': 'base64',
+                'content': base64.b64encode(content).decode('ascii')}
+    return {'filename': filename, 'mimetype': mimetype, 'content': content}
@@ -0,0 +1,162 @@
+"""
+.. module:: mail_templated.personalize
+   :synopsis: Rendering of shared content with personalised variables.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import re
+import uuid
+
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from .message import EmailMessage
+from .parser import BLOCKS
+
+
+class PersonalizedTemplate(object):
+    """
+    Email template that is rendered once for many recipients, and then only
+    the personalised variables are substituted for each recipient.
+
+    The template is rendered with placeholders instead of the personalised
+    variables. The placeholders are replaced with the actual values for each
+    recipient. The values are escaped in the html part, and they are inserted
+    as is into the subject and body, just like the values rendered by the
+    :ref:`base template <inheritance>`.
+
+    Note
+    ----
+    The personalised variables should be output as is, like
+    ``{{ user_name }}``. The template filters, tags and conditions are
+    applied to the placeholders instead of the actual values, so they can not
+    be used with these variables.
+
+    Arguments
+    ---------
+    template_name : str
+        |template_name|
+    context : dict
+        The context shared by all recipients.
+    variables : iterable
+        The names of the personalised variables.
+    """
+
+    def __init__(self, template_name, context, variables):
+        self.template_name = template_name
+        self.context = context
+        self.variables = tuple(variables)
+        self._segments = None
+
+    def get_content(self, personal_context):
+        """
+        Get the email parts for the recipient.
+
+        The template is rendered on the first call.
+
+        Arguments
+        ---------
+        personal_context : dict
+            The values of the personalised variables.
+
+        Returns
+        -------
+        dict
+            The content of the parts by their names. The value is ``None`` if
+            the part is not found in the rendered template.
+        """
+        if self._segments is None:
+            self._render()
+        content = {}
+        for block, segments in self._segments.items():
+            if segments is None:
+                content[block] = None
+                continue
+            escape = conditional_escape if block == 'html' else _to_text
+            content[block] = ''.join(
+                segment if i % 2 == 0 else escape(personal_context[segment])
+                for i, segment in enumerate(segments))
+        return content
+
+    def _render(self):
+        # The placeholders consist of letters, digits and underscores, so
+        # they pass through the html processors like the CSS inliners.
+        key = uuid.uuid4().hex
+        prefix = 'mailtemplated%s_' % key
+        suffix = '_%s' % key
+        placeholders = dict((name, mark_safe(prefix + name + suffix))
+                            for name in self.variables)
+        context = dict(self.context, **placeholders)
+        message = EmailMessage(self.template_name, context)
+        content = message._render_parts(None, BLOCKS)
+        # The odd segments are the names of the variables.
+        regex = re.compile('%s(%s)%s' % (
+            re.escape(prefix),
+            '|'.join(re.escape(name) for name in self.variables) or '(?!)',
+            re.escape(suffix)))
+        self._segments = dict(
+            (block, None if value is None else regex.split(value))
+            for block, value in content.items())
+
+
+def _to_text(value):
+    return '%s' % (value,)
+
+
+def iter_personalized_messages(template_name, context, datatuple,
+                               from_email=None, variables=None, **kwargs):
+    """
+    Lazily render messages that differ only by few personalised variables.
+
+    The template is rendered only once with the shared ``context``, and only
+    the personalised variables are substituted for each recipient. This is
+    much faster than rendering of the full template for each recipient. See
+    :class:`~mail_templated.personalize.PersonalizedTemplate` for the
+    limitations.
+
+    Arguments
+    ---------
+    template_name : str
+        |template_name|
+    context : dict
+        The context shared by all recipients.
+    datatuple : iterable
+        An iterable of ``(personal_context, recipient_list)`` pairs. The
+        ``personal_context`` contains the values of the personalised
+        variables.
+
+    Keyword Arguments
+    -----------------
+    from_email : str
+        |from_email|
+    variables : iterable
+        The names of the personalised variables. Defaults to the keys of the
+        first personal context.
+    clean : bool
+        If ``True``, remove any template specific properties from the
+        messages after rendering. Default is ``True``.
+
+    Any other keyword arguments are passed to the
+    :class:`~mail_templated.EmailMessage` constructor of every message.
+
+    Yields
+    ------
+    EmailMessage
+        Rendered message.
+    """
+    clean = kwargs.pop('clean', True)
+    alternatives = kwargs.pop('alternatives', None) or []
+    template = None
+    for personal_context, recipient_list in datatuple:
+        if template is None:
+            template = PersonalizedTemplate(
+                template_name, context,
+                personal_context.keys() if variables is None else variables)
+        message = EmailMessage(None, None, from_email, recipient_list,
+                               alternatives=list(alternatives), **kwargs)
+        message._set_content(template.get_content(personal_context))
+        message._is_rendered = True
+        if clean:
+            message.clean()
+        yield message
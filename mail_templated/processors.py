@@ -0,0 +1,153 @@
+"""
+.. module:: mail_templated.processors
+   :synopsis: Post-processing of the rendered html part.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+
+The processors are functions that take the rendered html and return the
+transformed html. They are listed in the ``MAIL_TEMPLATED_HTML_PROCESSORS``
+setting as callables or dotted paths, and applied in order after the template
+is rendered. The results are cached by the hash of the rendered html, so the
+messages with identical html are processed only once.
+"""
+
+import hashlib
+import re
+
+from django.test.signals import setting_changed
+
+from .cache import LRUCache
+from .conf import app_settings, get_callable
+
+
+class ProcessorCache(LRUCache):
+    """
+    Cache of the processed html.
+
+    It is configured with the ``MAIL_TEMPLATED_HTML_PROCESSORS_CACHE_SIZE``
+    setting.
+    """
+
+    def __init__(self):
+        super(ProcessorCache, self).__init__(0)
+
+    @property
+    def max_size(self):
+        return app_settings.HTML_PROCESSORS_CACHE_SIZE
+
+
+processor_cache = ProcessorCache()
+
+_processors = None
+
+
+def get_processors():
+    """
+    Get the processor functions from the ``MAIL_TEMPLATED_HTML_PROCESSORS``
+    setting.
+    """
+    global _processors
+    value = app_settings.HTML_PROCESSORS
+    if _processors is None or _processors[0] is not value:
+        _processors = value, tuple(get_callable(processor)
+                                   for processor in value)
+    return _processors[1]
+
+
+def process_html(html):
+    """
+    Apply the processors to the html.
+
+    Arguments
+    ---------
+    html : str
+        The rendered html part.
+
+    Returns
+    -------
+    str
+        The processed html, or the same html if there are no processors.
+    """
+    processors = get_processors()
+    if not processors or not html:
+        return html
+    key = hashlib.sha1(html.encode('utf-8')).hexdigest()
+    result = processor_cache.get(key)
+    if result is None:
+        result = html
+        for processor in processors:
+            result = processor(result)
+        processor_cache.set(key, result)
+    return result
+
+
+# The elements where the whitespace is significant, and the comments. The
+# conditional comments for Outlook are preserved.
+_PRESERVE_RE = re.compile(
+    r'(<(pre|textarea|script|style)\b.*?</\2\s*>|<!--\[if.*?<!\[endif\]-->)',
+    re.IGNORECASE | re.DOTALL)
+_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+# The tags, and the quoted attribute values inside them.
+_TAG_RE = re.compile(r'''(<[A-Za-z/!][^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>)''')
+_ATTR_VALUE_RE = re.compile(r'''("[^"]*"|'[^']*')''')
+_LINE_SPACE_RE = re.compile(r'\s*\n\s*')
+_SPACE_RE = re.compile(r'[ \t\f\v]+')
+
+
+def minify_html(html):
+    """
+    Remove the comments and collapse the whitespace in the html.
+
+    The whitespace runs are replaced with a single space, or with a single
+    line break if they contain one, so that the lines do not exceed the
+    length limit of email. The content of the ``pre``, ``textarea``,
+    ``script`` and ``style`` elements, the quoted attribute values and the
+    conditional comments are not changed.
+    """
+    chunks = _PRESERVE_RE.split(html)
+    result = []
+    # The split() returns the preserved elements and the names of their tags
+    # after every other chunk.
+    for i in range(0, len(chunks), 3):
+        chunk = _COMMENT_RE.sub('', chunks[i])
+        # The odd segments are the tags.
+        for j, segment in enumerate(_TAG_RE.split(chunk)):
+            if j % 2 == 0:
+                result.append(_collapse_space(segment))
+                continue
+            # The odd parts are the attribute values.
+            result.extend(
+                part if k % 2 else _collapse_space(part)
+                for k, part in enumerate(_ATTR_VALUE_RE.split(segment)))
+        if i + 1 < len(chunks):
+            result.append(chunks[i + 1])
+    return ''.join(result).strip()
+
+
+def _collapse_space(text):
+    return _SPACE_RE.sub(' ', _LINE_SPACE_RE.sub('\n', text))
+
+
+def inline_css(html):
+    """
+    Move the CSS rules from the ``<style>`` elements to the ``style``
+    attributes using the function specified by the
+    ``MAIL_TEMPLATED_CSS_INLINER`` setting, for example
+    ``'premailer.transform'``.
+
+    Returns the html as is if the inliner is not set.
+    """
+    inliner = get_callable(app_settings.CSS_INLINER)
+    if inliner is None:
+        return html
+    return inliner(html)
+
+
+def _clear_cache(**kwargs):
+    setting = kwargs['setting']
+    if (setting.startswith('MAIL_TEMPLATED_HTML_PROCESSORS') or
+            setting == 'MAIL_TEMPLATED_CSS_INLINER'):
+        processor_cache.clear()
+
+
+setting_changed.connect(_clear_cache)
@@ -0,0 +1,57 @@
+"""
+.. module:: mail_templated.signals
+   :synopsis: Instrumentation of django-mail-templated package.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+from timeit import default_timer
+
+from django.dispatch import Signal
+
+from .conf import app_settings, get_callable
+
+
+#: Sent after each stage of the message processing. The sender is the class of
+#: the message. The keyword arguments are ``message``, ``stage`` (one of
+#: ``'load_template'``, ``'render'``, ``'extract'``, ``'process'`` and
+#: ``'send'``), ``duration`` in seconds, ``template_name`` and ``size`` (the
+#: length of the rendered template, the total length of the extracted parts or
+#: the length of the processed html, ``None`` for other stages).
+timing = Signal()
+
+
+def is_enabled():
+    """
+    Check if anybody listens for the timings.
+
+    The timings are not measured at all if there are no receivers of the
+    :data:`timing` signal and the ``MAIL_TEMPLATED_METRICS_CALLBACK`` setting
+    is not set.
+    """
+    return bool(timing.receivers) or bool(app_settings.METRICS_CALLBACK)
+
+
+def start():
+    """
+    Get the start time for :func:`emit()`.
+    """
+    return default_timer()
+
+
+def emit(stage, message, start_time, size=None):
+    """
+    Send the timing of the stage to the metrics callback and the signal
+    receivers.
+    """
+    duration = default_timer() - start_time
+    data = {
+        'stage': stage,
+        'duration': duration,
+        'template_name': getattr(message, 'template_name', None),
+        'size': size,
+    }
+    callback = get_callable(app_settings.METRICS_CALLBACK)
+    if callback is not None:
+        callback(message=message, **data)
+    timing.send(sender=message.__class__, message=message, **data)
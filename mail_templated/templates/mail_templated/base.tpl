@@ -1,5 +1,5 @@
-{{ TAG_START_SUBJECT }}{% autoescape off %}{% block subject %}{% endblock %}{% endautoescape %}{{ TAG_END_SUBJECT }}
+{% if not SKIP_SUBJECT %}{{ TAG_START_SUBJECT }}{% autoescape off %}{% block subject %}{% endblock %}{% endautoescape %}{{ TAG_END_SUBJECT }}{% endif %}
 
-{{ TAG_START_BODY }}{% autoescape off %}{% block body %}{% endblock %}{% endautoescape %}{{ TAG_END_BODY }}
+{% if not SKIP_BODY %}{{ TAG_START_BODY }}{% autoescape off %}{% block body %}{% endblock %}{% endautoescape %}{{ TAG_END_BODY }}{% endif %}
 
-{{ TAG_START_HTML }}{% block html %}{% endblock %}{{ TAG_END_HTML }}
+{% if not SKIP_HTML %}{{ TAG_START_HTML }}{% block html %}{% endblock %}{{ TAG_END_HTML }}{% endif %}
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the hot paths of the application.
+
+Run this module directly to see the results, no Django project is required.
+Pass ``--json FILE`` to save the results, and ``--compare FILE`` to compare
+them with the results saved earlier, for example with the previous release.
+"""
+import argparse
+import json
+import pickle
+import platform
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4
+    tracemalloc = None
+
+
+def legacy_get_block(content, name, tag_format):
+    """The email part extraction as it was implemented before BlockParser"""
+    marks = tuple(tag_format.format(block=name, bound=bound)
+                  for bound in ('start', 'end'))
+    start, end = (content.find(m) for m in marks)
+    if start == -1 or end == -1:
+        return
+    return content[start + len(marks[0]) : end].strip('\n\r')
+
+
+def make_document(tag_format, body_size, html_size):
+    tags = dict(((block, bound), tag_format.format(block=block, bound=bound))
+                for block in ('subject', 'body', 'html')
+                for bound in ('start', 'end'))
+    return ''.join([
+        tags['subject', 'start'], 'Hello User', tags['subject', 'end'],
+        '\n\n',
+        tags['body', 'start'], 'Plain text line.\n' * body_size,
+        tags['body', 'end'],
+        '\n\n',
+        tags['html', 'start'], '<p>Html paragraph.</p>\n' * html_size,
+        tags['html', 'end'],
+    ])
+
+
+def make_large_context(lines=500):
+    return {
+        'name': 'User',
+        'order_id': 1,
+        'lines': [{'name': 'Item %d' % i, 'quantity': i % 5 + 1,
+                   'price': '%d.99' % i} for i in range(lines)],
+    }
+
+
+def make_wide_context(size=1000):
+    context = dict(('var%d' % i, i) for i in range(size))
+    context['name'] = 'User'
+    return context
+
+
+def measure_allocation(func):
+    """
+    Get the peak memory allocated by the function call in bytes, or ``None``
+    if :mod:`tracemalloc` is not available.
+    """
+    if tracemalloc is None:
+        return None
+    func()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Benchmark(object):
+    """Collect the timings of the benchmark functions"""
+
+    def __init__(self, number=None, repeat=3):
+        self.number = number
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, func, number, size=None):
+        """
+        Run the function and save the best time per call in seconds.
+        """
+        number = self.number or number
+        seconds = min(timeit.repeat(func, number=number,
+                                    repeat=self.repeat)) / number
+        self.results[name] = {'seconds': seconds, 'size': size}
+        return seconds
+
+
+def bench_render(bench):
+    from mail_templated import EmailMessage
+
+    small = EmailMessage('mail_templated_test/plain.tpl', {'name': 'User'})
+    small.load_template()
+    bench.run('render.small', lambda: small.render(), 2000)
+
+    multipart = EmailMessage('mail_templated_test/multipart.html',
+                             {'name': 'User'})
+    multipart.load_template()
+
+    def render_multipart():
+        multipart.alternatives = []
+        multipart.render()
+
+    bench.run('render.multipart', render_multipart, 2000)
+
+    large = EmailMessage('mail_templated_test/large.html',
+                         make_large_context())
+    large.load_template()
+
+    def render_large():
+        large.alternatives = []
+        large.render()
+
+    render_large()
+    bench.run('render.large', render_large, 20,
+              len(large.body) + len(large.alternatives[0][0]))
+
+    def render_subject():
+        large.render(parts=('subject',))
+
+    bench.run('render.large.subject', render_subject, 200)
+
+    def load_template():
+        EmailMessage('mail_templated_test/plain.tpl').load_template()
+
+    bench.run('load_template', load_template, 2000)
+
+
+def bench_context(bench):
+    from mail_templated import EmailMessage
+    from mail_templated.parser import BLOCKS
+
+    message = EmailMessage('mail_templated_test/plain.tpl',
+                           make_wide_context())
+    message.load_template()
+
+    def legacy():
+        # The context was copied for every render.
+        context = message.context.copy()
+        context.update(message.extra_context)
+        message.template.render(context)
+
+    def layered():
+        render, context = message._make_context(message.context)
+        context.update(message.extra_context)
+        render(context)
+
+    # The size is the peak memory allocated by the call.
+    bench.run('context.wide.legacy', legacy, 2000, measure_allocation(legacy))
+    bench.run('context.wide.layered', layered, 2000,
+              measure_allocation(layered))
+    bench.run('render.wide_context',
+              lambda: message._render_parts(None, BLOCKS), 2000)
+
+
+def bench_extract(bench):
+    from mail_templated.parser import BlockParser
+
+    tag_format = '###{bound}_{block}###'
+    parser = BlockParser(tag_format)
+
+    def legacy(content):
+        # The subject was extracted twice.
+        for name in ('subject', 'subject', 'body', 'html'):
+            legacy_get_block(content, name, tag_format)
+
+    for label, body_size, html_size, number in (('small', 1, 1, 10000),
+                                                ('large', 2000, 13000, 200)):
+        content = make_document(tag_format, body_size, html_size)
+        bench.run('extract.%s.legacy' % label, lambda: legacy(content),
+                  number, len(content))
+        bench.run('extract.%s.parser' % label, lambda: parser.parse(content),
+                  number, len(content))
+
+
+def bench_extra_context(bench):
+    from mail_templated import EmailMessage
+
+    from mail_templated.conf import app_settings
+
+    message = EmailMessage()
+    bench.run('extra_context', lambda: message.extra_context, 20000)
+    bench.run('app_settings', lambda: app_settings.TAG_FORMAT, 100000)
+
+
+def bench_pickle(bench):
+    from mail_templated import EmailMessage
+
+    message = EmailMessage('mail_templated_test/plain.tpl', {'name': 'User'},
+                           'from@inter.net', ['to@inter.net'])
+    bench.run('pickle.unrendered',
+              lambda: pickle.loads(pickle.dumps(message)), 5000,
+              len(pickle.dumps(message)))
+    message = EmailMessage('mail_templated_test/large.html',
+                           make_large_context(), 'from@inter.net',
+                           ['to@inter.net'], render=True)
+    bench.run('pickle.rendered.large',
+              lambda: pickle.loads(pickle.dumps(message)), 100,
+              len(pickle.dumps(message)))
+
+
+def bench_send(bench):
+    from django.core import mail
+    from mail_templated import send_mail, send_mass_mail
+
+    connection = mail.get_connection(
+        'django.core.mail.backends.locmem.EmailBackend')
+
+    def send():
+        mail.outbox = []
+        send_mail('mail_templated_test/plain.tpl', {'name': 'User'},
+                  'from@inter.net', ['to@inter.net'], connection=connection)
+
+    bench.run('send_mail', send, 500)
+
+    datatuple = [({'name': 'User%d' % i}, ['to%d@inter.net' % i])
+                 for i in range(100)]
+
+    def send_mass():
+        mail.outbox = []
+        send_mass_mail('mail_templated_test/plain.tpl', datatuple,
+                       'from@inter.net', connection=connection)
+
+    bench.run('send_mass_mail.100', send_mass, 5)
+
+
+def bench_attachments(bench):
+    from django.test.utils import override_settings
+    from mail_templated import EmailMessage
+
+    message = EmailMessage('mail_templated_test/plain.tpl', {'name': 'User'},
+                           'from@inter.net', ['to@inter.net'], render=True)
+    content = b'%PDF' + bytes(bytearray(range(256))) * 4096
+    message.attach('brochure.pdf', content, 'application/pdf')
+    bench.run('attachment.1mb', message.message, 20, len(content))
+    with override_settings(MAIL_TEMPLATED_ATTACHMENT_CACHE_SIZE=10):
+        bench.run('attachment.1mb.cached', message.message, 20, len(content))
+
+
+def bench_mime(bench):
+    from django.test.utils import override_settings
+    from mail_templated import EmailMessage
+
+    message = EmailMessage('mail_templated_test/multipart.html',
+                           {'name': 'User'}, 'from@inter.net', ['to@inter.net'],
+                           render=True)
+    message.attach('data.bin', b'\x00' * 10000, 'application/octet-stream')
+
+    def serialize():
+        message.message().as_bytes()
+
+    bench.run('mime.multipart', serialize, 1000)
+    with override_settings(MAIL_TEMPLATED_MIME_SKELETON_CACHE_SIZE=10):
+        bench.run('mime.multipart.skeleton', serialize, 1000)
+
+
+BENCHMARKS = (bench_render, bench_context, bench_extract, bench_extra_context,
+              bench_pickle, bench_send, bench_attachments, bench_mime)
+
+
+def run_benchmarks(number=None, repeat=3, names=None):
+    """
+    Run the benchmarks and return the results as a JSON compatible dict.
+
+    Django should be initialised already.
+    """
+    import django
+
+    bench = Benchmark(number, repeat)
+    for func in BENCHMARKS:
+        if not names or func.__name__[len('bench_'):] in names:
+            func(bench)
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'results': bench.results,
+    }
+
+
+def print_results(data, baseline=None):
+    for name in sorted(data['results']):
+        result = data['results'][name]
+        line = '%-24s %12.2f us' % (name, result['seconds'] * 1e6)
+        if result['size']:
+            line += ' %10d bytes' % result['size']
+        if baseline and name in baseline['results']:
+            line += ' %8.2fx' % (baseline['results'][name]['seconds'] /
+                                 result['seconds'])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', help='benchmarks to run: %s' % (
+        ', '.join(f.__name__[len('bench_'):] for f in BENCHMARKS)))
+    parser.add_argument('--json', help='save the results to the JSON file')
+    parser.add_argument('--compare', help='show the speedup relative to the '
+                                          'results saved in the JSON file')
+    parser.add_argument('--number', type=int,
+                        help='override the number of calls per timing')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the number of timings, the best one is used')
+    args = parser.parse_args(argv)
+
+    from django_setup import setup_django
+    setup_django()
+
+    data = run_benchmarks(args.number, args.repeat, args.names)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(data, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
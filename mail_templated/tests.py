@@ -5,14 +5,26 @@
 # caused import errors with old Django version.
 import os
 import pickle
+import shutil
+import smtplib
+import sys
+import tempfile
 
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
 from django.template import TemplateDoesNotExist
 from django.template.loader import get_template
 from django.test import TestCase
 from django.utils import translation
 
-from . import send_mail, EmailMessage
+from .cache import LRUCache, render_cache, template_cache
+from .parser import BlockParser, get_parser
+from .personalize import PersonalizedTemplate
+from .signals import timing
+from . import (send_mail, send_mass_mail, iter_rendered_messages,
+               send_messages, iter_personalized_messages,
+               iter_queryset_messages, iter_localized_messages,
+               send_localized_mail, EmailMessage)
 
 
 CONTEXT2 = {'name': 'User2'}
@@ -20,6 +32,27 @@ SUBJECT2 = 'Hello User2'
 BODY2 = 'User2, this is a plain text message.'
 
 
+class CountingEmailBackend(EmailBackend):
+    """Locmem backend that counts the connections and the backend calls"""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingEmailBackend, self).__init__(*args, **kwargs)
+        self.open_count = 0
+        self.close_count = 0
+        self.send_count = 0
+
+    def open(self):
+        self.open_count += 1
+        return True
+
+    def close(self):
+        self.close_count += 1
+
+    def send_messages(self, messages):
+        self.send_count += 1
+        return super(CountingEmailBackend, self).send_messages(messages)
+
+
 class BaseMailTestCase(TestCase):
 
     def _assertMessage(self, from_email, to, subject, body,
@@ -425,3 +458,1485 @@ class RenderTestCase(BaseMailTestCase):
         message.context = CONTEXT2
         message.send()
         self._assertIsRendered(message, True)
+
+
+class NoCopyDict(dict):
+
+    def copy(self):
+        raise AssertionError('The context should not be copied.')
+
+
+class LayeredContextTestCase(BaseMailTestCase):
+
+    def test_context_not_copied(self):
+        context = NoCopyDict(name='User')
+        message = EmailMessage('mail_templated_test/plain.tpl', context,
+                               render=True)
+        self.assertEqual(message.subject, 'Hello User')
+        self.assertEqual(context, {'name': 'User'})
+
+    def test_context_not_modified(self):
+        from django.template import engines
+        context = {'name': 'User', 'x': 'orig'}
+        message = EmailMessage(None, context)
+        message.template = engines['django'].from_string(
+            '{% extends "mail_templated/base.tpl" %}'
+            '{% block body %}{% cycle "a" "b" as x silent %}'
+            '{% cycle "c" "d" as y silent %}{{ x }}{{ y }}{% endblock %}')
+        message.render()
+        self.assertEqual(message.body, 'ac')
+        self.assertEqual(context, {'name': 'User', 'x': 'orig'})
+
+    def test_autoescape(self):
+        message = EmailMessage('mail_templated_test/plain.html',
+                               {'name': 'Tom & Jerry'}, render=True)
+        self.assertEqual(message.subject, 'Hello Tom & Jerry')
+        self.assertEqual(message.body,
+                         'Tom &amp; Jerry, this is an html message.')
+
+
+class SendMassMailTestCase(BaseMailTestCase):
+
+    def _datatuple(self, count):
+        return [({'name': 'User%d' % i}, ['to%d@inter.net' % i])
+                for i in range(count)]
+
+    def test_send(self):
+        sent = send_mass_mail('mail_templated_test/plain.tpl',
+                              self._datatuple(3), 'from@inter.net')
+        self.assertEqual(sent, 3)
+        self.assertEqual(len(mail.outbox), 3)
+        for i, message in enumerate(mail.outbox):
+            self.assertEqual(message.from_email, 'from@inter.net')
+            self.assertEqual(message.to, ['to%d@inter.net' % i])
+            self.assertEqual(message.subject, 'Hello User%d' % i)
+            self.assertEqual(message.body,
+                             'User%d, this is a plain text message.' % i)
+
+    def test_single_connection(self):
+        connection = CountingEmailBackend()
+        sent = send_mass_mail('mail_templated_test/plain.tpl',
+                              self._datatuple(5), 'from@inter.net',
+                              connection=connection, chunk_size=2)
+        self.assertEqual(sent, 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(connection.open_count, 1)
+        self.assertEqual(connection.close_count, 1)
+        self.assertEqual(connection.send_count, 3)
+
+    def test_generator(self):
+        datatuple = (item for item in self._datatuple(3))
+        sent = send_mass_mail('mail_templated_test/plain.tpl', datatuple,
+                              'from@inter.net')
+        self.assertEqual(sent, 3)
+
+    def test_multipart_alternatives(self):
+        send_mass_mail('mail_templated_test/multipart.html',
+                       self._datatuple(2), 'from@inter.net',
+                       alternatives=[('HTML alternative', 'text/html')])
+        for i, message in enumerate(mail.outbox):
+            self.assertEqual(message.alternatives[0][0], 'HTML alternative')
+            self.assertEqual(message.alternatives[1][0],
+                             'User%d, this is an html part.' % i)
+            self.assertEqual(len(message.alternatives), 2)
+
+
+class StreamingTestCase(BaseMailTestCase):
+
+    def _datatuple(self, count, consumed):
+        for i in range(count):
+            consumed.append(i)
+            yield {'name': 'User%d' % i}, ['to%d@inter.net' % i]
+
+    def test_lazy_rendering(self):
+        consumed = []
+        messages = iter_rendered_messages(
+            'mail_templated_test/plain.tpl', self._datatuple(3, consumed),
+            'from@inter.net')
+        self.assertEqual(consumed, [])
+        message = next(messages)
+        self.assertEqual(consumed, [0])
+        self.assertTrue(message.is_rendered)
+        self.assertEqual(message.subject, 'Hello User0')
+        self._assertMessageClean(message, True)
+        self.assertEqual(len(list(messages)), 2)
+
+    def test_no_clean(self):
+        messages = iter_rendered_messages(
+            'mail_templated_test/plain.tpl', self._datatuple(1, []),
+            'from@inter.net', clean=False)
+        self._assertMessageClean(next(messages), False)
+
+    def test_send_messages(self):
+        consumed = []
+        connection = CountingEmailBackend()
+        messages = iter_rendered_messages(
+            'mail_templated_test/plain.tpl', self._datatuple(5, consumed),
+            'from@inter.net')
+        sent = send_messages(messages, connection, chunk_size=2)
+        self.assertEqual(sent, 5)
+        self.assertEqual(consumed, [0, 1, 2, 3, 4])
+        self.assertEqual(connection.send_count, 3)
+        self.assertEqual(connection.open_count, 1)
+        self.assertEqual([m.to for m in mail.outbox],
+                         [['to%d@inter.net' % i] for i in range(5)])
+
+    def test_send_empty(self):
+        connection = CountingEmailBackend()
+        self.assertEqual(send_messages([], connection), 0)
+        self.assertEqual(connection.send_count, 0)
+
+
+class ParallelRenderTestCase(BaseMailTestCase):
+
+    def test_render(self):
+        from .parallel import render_parallel
+        connection = CountingEmailBackend()
+        messages = [
+            EmailMessage('mail_templated_test/plain.tpl', {'name': 'User0'},
+                         'from@inter.net', ['to0@inter.net'],
+                         connection=connection),
+            ('mail_templated_test/multipart.html', {'name': 'User1'}),
+            ('mail_templated_test/plain.tpl', {'name': 'User2'}),
+        ]
+        rendered = render_parallel(messages, max_workers=2, chunk_size=1)
+        self.assertEqual(len(rendered), 3)
+        self.assertTrue(all(m.is_rendered for m in rendered))
+        self.assertEqual([m.subject for m in rendered],
+                         ['Hello User0', 'Hello User1', 'Hello User2'])
+        self.assertEqual(rendered[0].to, ['to0@inter.net'])
+        self.assertIs(rendered[0].connection, connection)
+        self.assertEqual(rendered[1].alternatives,
+                         [('User1, this is an html part.', 'text/html')])
+        rendered[0].send()
+        self.assertEqual(connection.send_count, 1)
+
+    def test_empty(self):
+        from .parallel import render_parallel
+        self.assertEqual(render_parallel([]), [])
+
+    def test_executor(self):
+        from .parallel import create_executor, render_parallel
+        message = EmailMessage('mail_templated_test/plain.tpl',
+                               {'name': 'User0'})
+        message.load_template()
+        executor = create_executor(1, ['mail_templated_test/plain.tpl'])
+        try:
+            first = render_parallel([message], executor=executor)
+            second = render_parallel(
+                [('mail_templated_test/multipart.html', {'name': 'User1'})],
+                executor=executor)
+            pid = executor.submit(os.getpid).result()
+            self.assertEqual(executor.submit(os.getpid).result(), pid)
+        finally:
+            executor.shutdown()
+        self.assertEqual(first[0].subject, 'Hello User0')
+        self.assertEqual(second[0].subject, 'Hello User1')
+
+
+class BlockParserTestCase(TestCase):
+
+    def setUp(self):
+        self.parser = BlockParser('###{bound}_{block}###')
+
+    def test_parse(self):
+        parts = self.parser.parse(
+            '###start_subject###Subject###end_subject###\n\n'
+            '###start_body###\nBody\n###end_body###\n\n'
+            '###start_html######end_html###')
+        self.assertEqual(parts, {'subject': 'Subject', 'body': 'Body',
+                                 'html': ''})
+
+    def test_missing(self):
+        parts = self.parser.parse('###start_body###Body###end_body###'
+                                  '###start_html###Html')
+        self.assertEqual(parts, {'subject': None, 'body': 'Body',
+                                 'html': None})
+
+    def test_order(self):
+        parts = self.parser.parse(
+            '###start_html###Html###end_html###'
+            '###start_body###Body###end_body###'
+            '###start_subject###Subject###end_subject###')
+        self.assertEqual(parts, {'subject': 'Subject', 'body': 'Body',
+                                 'html': 'Html'})
+
+    def test_get_block(self):
+        self.assertEqual(self.parser.get_block(
+            '###start_subject###Subject###end_subject###', 'subject'),
+            'Subject')
+
+    def test_get_parser(self):
+        from django.test.utils import override_settings
+        self.assertIs(get_parser(), get_parser())
+        with override_settings(MAIL_TEMPLATED_TAG_FORMAT='<!--{block}-->'):
+            parser = get_parser()
+            self.assertEqual(parser.tag_format, '<!--{block}-->')
+            self.assertEqual(parser.parse('<!--subject-->S<!--subject-->')
+                             ['subject'], 'S')
+        self.assertEqual(get_parser().tag_format, '###{bound}_{block}###')
+
+
+class PartialRenderTestCase(BaseMailTestCase):
+
+    def test_subject(self):
+        message = EmailMessage('mail_templated_test/multipart.html',
+                               {'name': 'User'}, 'from@inter.net',
+                               ['to@inter.net'], body='Static body')
+        message.render(parts=('subject',))
+        self.assertEqual(message.subject, 'Hello User')
+        self.assertEqual(message.body, 'Static body')
+        self.assertEqual(message.alternatives, [])
+        self.assertFalse(message.is_rendered)
+        message.send()
+        self._assertMessage('from@inter.net', ['to@inter.net'],
+                            'Hello User', 'User, this is a plain text part.')
+
+    def test_skip_rendering(self):
+        message = EmailMessage('mail_templated_test/multipart.html',
+                               {'name': 'User'})
+        message.load_template()
+        result = message.template.render(dict(
+            message.extra_context, name='User', SKIP_BODY=True,
+            SKIP_HTML=True))
+        self.assertNotIn('plain text part', result)
+        self.assertNotIn('html part', result)
+        self.assertIn('Hello User', result)
+
+    def test_html_without_body(self):
+        message = EmailMessage('mail_templated_test/multipart.html',
+                               {'name': 'User'})
+        message.render(parts=['subject', 'html'])
+        self.assertEqual(message.alternatives,
+                         [('User, this is an html part.', 'text/html')])
+        self.assertEqual(message.content_subtype, 'plain')
+
+    def test_html_then_send(self):
+        message = EmailMessage('mail_templated_test/multipart.html',
+                               {'name': 'User'}, 'from@inter.net',
+                               ['to@inter.net'])
+        message.attach_alternative('<p>Static</p>', 'text/html')
+        message.render(parts=('html',))
+        message.render(parts=('html',))
+        self.assertEqual(len(message.alternatives), 2)
+        self.assertFalse(message.is_rendered)
+        message.send()
+        self.assertEqual(mail.outbox[0].alternatives, [
+            ('<p>Static</p>', 'text/html'),
+            ('User, this is an html part.', 'text/html')])
+
+    def test_html_body(self):
+        message = EmailMessage('mail_templated_test/plain.html',
+                               {'name': 'User'})
+        message.render(parts=['body', 'html'])
+        self.assertEqual(message.body, 'User, this is an html message.')
+        self.assertEqual(message.content_subtype, 'html')
+        self.assertFalse(message.is_rendered)
+
+    def test_unknown(self):
+        message = EmailMessage('mail_templated_test/plain.tpl')
+        self.assertRaises(ValueError, message.render, parts=('header',))
+
+
+class AppSettingsTestCase(TestCase):
+
+    def test_cached(self):
+        from django.conf import settings
+        from mail_templated.conf import app_settings
+        app_settings.clear_cache()
+        self.assertEqual(app_settings.MASS_MAIL_CHUNK_SIZE, 100)
+        self.assertIn('MASS_MAIL_CHUNK_SIZE', app_settings.__dict__)
+        # Direct assignment does not send the setting_changed signal.
+        settings.MAIL_TEMPLATED_MASS_MAIL_CHUNK_SIZE = 5
+        try:
+            self.assertEqual(app_settings.MASS_MAIL_CHUNK_SIZE, 100)
+            app_settings.clear_cache('MASS_MAIL_CHUNK_SIZE')
+            self.assertEqual(app_settings.MASS_MAIL_CHUNK_SIZE, 5)
+        finally:
+            del settings.MAIL_TEMPLATED_MASS_MAIL_CHUNK_SIZE
+            app_settings.clear_cache()
+        self.assertEqual(app_settings.MASS_MAIL_CHUNK_SIZE, 100)
+
+    def test_override_settings(self):
+        from django.test.utils import override_settings
+        from mail_templated.conf import app_settings
+        self.assertEqual(app_settings.MASS_MAIL_CHUNK_SIZE, 100)
+        with override_settings(MAIL_TEMPLATED_MASS_MAIL_CHUNK_SIZE=5):
+            self.assertEqual(app_settings.MASS_MAIL_CHUNK_SIZE, 5)
+        self.assertEqual(app_settings.MASS_MAIL_CHUNK_SIZE, 100)
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1,
+                                         'evictions': 1, 'size': 2,
+                                         'max_size': 2})
+
+    def test_timeout(self):
+        cache = LRUCache(2, timeout=-1)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a', 'expired'), 'expired')
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['hits'], 0)
+
+
+class TemplateCacheTestCase(BaseMailTestCase):
+
+    def setUp(self):
+        template_cache.clear()
+
+    def tearDown(self):
+        template_cache.clear()
+
+    def _load(self):
+        message = EmailMessage('mail_templated_test/plain.tpl')
+        message.load_template()
+        return message.template
+
+    def test_disabled(self):
+        self._load()
+        self._load()
+        self.assertEqual(template_cache.stats()['size'], 0)
+        self.assertEqual(template_cache.stats()['hits'], 0)
+
+    def test_enabled(self):
+        from django.test.utils import override_settings
+        with override_settings(MAIL_TEMPLATED_TEMPLATE_CACHE_SIZE=10):
+            template = self._load()
+            self.assertIs(self._load(), template)
+            stats = template_cache.stats()
+            self.assertEqual((stats['hits'], stats['misses'], stats['size']),
+                             (1, 1, 1))
+            send_mail('mail_templated_test/plain.tpl', {'name': 'User'},
+                      'from@inter.net', ['to@inter.net'])
+            self.assertEqual(template_cache.stats()['hits'], 2)
+        self.assertEqual(template_cache.stats()['size'], 0)
+
+    def test_check_mtime(self):
+        from django.test.utils import override_settings
+        template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, template_dir)
+        file_name = os.path.join(template_dir, 'mtime.tpl')
+        with open(file_name, 'w') as f:
+            f.write('###start_subject###Old###end_subject###')
+        # Disable the cached template loader of Django.
+        loaders = ['django.template.loaders.filesystem.Loader']
+        templates = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [template_dir],
+            'OPTIONS': {'loaders': loaders},
+        }]
+        with override_settings(
+                TEMPLATES=templates, TEMPLATE_DIRS=[template_dir],
+                TEMPLATE_LOADERS=loaders,
+                MAIL_TEMPLATED_TEMPLATE_CACHE_SIZE=10,
+                MAIL_TEMPLATED_TEMPLATE_CACHE_CHECK_MTIME=True):
+            message = EmailMessage('mtime.tpl', {}, render=True)
+            self.assertEqual(message.subject, 'Old')
+            with open(file_name, 'w') as f:
+                f.write('###start_subject###New###end_subject###')
+            mtime = os.path.getmtime(file_name) + 10
+            os.utime(file_name, (mtime, mtime))
+            message = EmailMessage('mtime.tpl', {}, render=True)
+            self.assertEqual(message.subject, 'New')
+            self.assertEqual(template_cache.stats()['misses'], 2)
+
+
+def _render_key(template_name, context):
+    return 'test:%s:%s' % (template_name, context['user'].name)
+
+
+class RenderCacheTestCase(BaseMailTestCase):
+
+    def setUp(self):
+        render_cache.clear()
+
+    def tearDown(self):
+        render_cache.clear()
+
+    def _render(self, context, template_name='mail_templated_test/plain.tpl'):
+        message = EmailMessage(template_name, context, render=True)
+        return message
+
+    def test_disabled(self):
+        self._render({'name': 'User'})
+        self._render({'name': 'User'})
+        self.assertEqual(render_cache.stats()['hits'], 0)
+
+    def test_enabled(self):
+        from django.test.utils import override_settings
+        with override_settings(MAIL_TEMPLATED_RENDER_CACHE_SIZE=10):
+            self._render({'name': 'User'}, 'mail_templated_test/multipart.html')
+            message = self._render({'name': 'User'},
+                                   'mail_templated_test/multipart.html')
+            self.assertIsNone(message.template)
+            self.assertTrue(message.is_rendered)
+            self.assertEqual(message.subject, 'Hello User')
+            self.assertEqual(message.body, 'User, this is a plain text part.')
+            self.assertEqual(message.alternatives,
+                             [('User, this is an html part.', 'text/html')])
+            self._render({'name': 'User2'})
+            stats = render_cache.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_not_serializable(self):
+        from django.test.utils import override_settings
+        with override_settings(MAIL_TEMPLATED_RENDER_CACHE_SIZE=10):
+            self._render({'name': 'User', 'object': object()})
+            self.assertEqual(render_cache.stats()['size'], 0)
+
+    def test_safe_strings(self):
+        from django.test.utils import override_settings
+        from django.utils.safestring import mark_safe
+        template_name = 'mail_templated_test/multipart.html'
+        with override_settings(MAIL_TEMPLATED_RENDER_CACHE_SIZE=10):
+            self._render({'name': mark_safe('<b>A</b>')}, template_name)
+            message = self._render({'name': '<b>A</b>'}, template_name)
+            self.assertEqual(message.alternatives, [
+                ('&lt;b&gt;A&lt;/b&gt;, this is an html part.', 'text/html')])
+            self._render({'name': [mark_safe('<b>A</b>')]}, template_name)
+            self._render({'name': ['<b>A</b>']}, template_name)
+            self.assertEqual(render_cache.stats()['hits'], 0)
+            self.assertEqual(render_cache.stats()['size'], 4)
+
+    def test_html_processors_changed(self):
+        from django.test.utils import override_settings
+        template_name = 'mail_templated_test/multipart.html'
+        with override_settings(MAIL_TEMPLATED_RENDER_CACHE_SIZE=10):
+            self._render({'name': 'User'}, template_name)
+            with override_settings(MAIL_TEMPLATED_HTML_PROCESSORS=[
+                    'mail_templated.tests.upper_html']):
+                message = self._render({'name': 'User'}, template_name)
+                self.assertEqual(message.alternatives[0][0],
+                                 'USER, THIS IS AN HTML PART.')
+            message = self._render({'name': 'User'}, template_name)
+            self.assertEqual(message.alternatives[0][0],
+                             'User, this is an html part.')
+
+    def test_key_function(self):
+        from django.test.utils import override_settings
+
+        class User(object):
+            name = 'User'
+
+        with override_settings(
+                MAIL_TEMPLATED_RENDER_CACHE_SIZE=10,
+                MAIL_TEMPLATED_RENDER_CACHE_KEY_FUNCTION=_render_key):
+            self._render({'name': 'User', 'user': User()})
+            self._render({'name': 'User', 'user': User()})
+            self.assertEqual(render_cache.stats()['hits'], 1)
+
+    def test_django_cache(self):
+        from django.test.utils import override_settings
+        caches = {'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=caches,
+                               MAIL_TEMPLATED_RENDER_CACHE_ALIAS='default'):
+            self._render({'name': 'User'})
+            message = self._render({'name': 'User'})
+            self.assertIsNone(message.template)
+            self.assertEqual(message.subject, 'Hello User')
+            self.assertEqual(render_cache.stats()['hits'], 1)
+            self.assertEqual(render_cache.stats()['size'], 0)
+
+
+def reject_nul(html):
+    if '\x00' in html:
+        raise ValueError('All strings must be XML compatible')
+    return html
+
+
+class PersonalizedTestCase(BaseMailTestCase):
+
+    template_name = 'mail_templated_test/personalized.html'
+    context = {'title': 'News', 'text': 'Tom & Jerry'}
+
+    def _datatuple(self):
+        return [({'name': 'User<%d>' % i, 'unsubscribe_url': '/u/?id=%d&a' % i},
+                 ['to%d@inter.net' % i]) for i in range(3)]
+
+    def test_same_as_full_render(self):
+        for personal_context, to in self._datatuple():
+            message = EmailMessage(self.template_name,
+                                   dict(self.context, **personal_context),
+                                   render=True)
+            template = PersonalizedTemplate(self.template_name, self.context,
+                                            ['name', 'unsubscribe_url'])
+            content = template.get_content(personal_context)
+            self.assertEqual(content['subject'], message.subject)
+            self.assertEqual(content['body'], message.body)
+            self.assertEqual(content['html'], message.alternatives[0][0])
+
+    def test_html_processors(self):
+        from django.test.utils import override_settings
+        with override_settings(MAIL_TEMPLATED_HTML_PROCESSORS=[
+                'mail_templated.tests.reject_nul']):
+            template = PersonalizedTemplate(self.template_name, self.context,
+                                            ['name', 'unsubscribe_url'])
+            content = template.get_content({'name': 'A', 'unsubscribe_url': ''})
+        self.assertIn('<p>Hello A! Tom &amp; Jerry</p>', content['html'])
+
+    def test_rendered_once(self):
+        template = PersonalizedTemplate(self.template_name, self.context,
+                                        ['name', 'unsubscribe_url'])
+        template.get_content({'name': 'A', 'unsubscribe_url': ''})
+        segments = template._segments
+        template.get_content({'name': 'B', 'unsubscribe_url': ''})
+        self.assertIs(template._segments, segments)
+
+    def test_iter_messages(self):
+        messages = list(iter_personalized_messages(
+            self.template_name, self.context, self._datatuple(),
+            'from@inter.net'))
+        self.assertEqual(len(messages), 3)
+        for i, message in enumerate(messages):
+            self.assertTrue(message.is_rendered)
+            self._assertMessageClean(message, True)
+            self.assertEqual(message.to, ['to%d@inter.net' % i])
+            self.assertEqual(message.subject, 'News for User<%d>' % i)
+            self.assertIn('Unsubscribe: /u/?id=%d&a' % i, message.body)
+            self.assertEqual(len(message.alternatives), 1)
+            self.assertIn('<p>Hello User&lt;%d&gt;! Tom &amp; Jerry</p>' % i,
+                          message.alternatives[0][0])
+        send_messages(messages)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_iter_messages_clean(self):
+        messages = list(iter_personalized_messages(
+            self.template_name, self.context, self._datatuple(),
+            'from@inter.net', clean=False))
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[0].subject, 'News for User<0>')
+        self.assertIsNone(messages[0].template_name)
+        self.assertTrue(hasattr(messages[0], 'context'))
+        messages = list(iter_localized_messages(
+            self.template_name, [(context, to, 'en') for context, to
+                                 in self._datatuple()],
+            shared_context=self.context, clean=True))
+        self._assertMessageClean(messages[0], True)
+
+
+class AsyncEmailBackend(CountingEmailBackend):
+    """Locmem backend with asynchronous interface"""
+
+    def asend_messages(self, messages):
+        import asyncio
+        self.async_count = getattr(self, 'async_count', 0) + 1
+        return asyncio.get_event_loop().run_in_executor(
+            None, self.send_messages, messages)
+
+
+class AsyncTestCase(BaseMailTestCase):
+
+    def setUp(self):
+        if sys.version_info < (3, 7):
+            from unittest import SkipTest
+            raise SkipTest('asyncio.run() is not available')
+
+    def _run(self, coroutine):
+        import asyncio
+        return asyncio.run(coroutine)
+
+    def test_asend(self):
+        message = EmailMessage('mail_templated_test/plain.tpl',
+                               {'name': 'User'}, 'from@inter.net',
+                               ['to@inter.net'])
+        self.assertEqual(self._run(message.asend()), 1)
+        self.assertTrue(message.is_rendered)
+        self._assertMessage('from@inter.net', ['to@inter.net'], 'Hello User',
+                            'User, this is a plain text message.')
+
+    def test_language(self):
+        from django.utils.translation import gettext_lazy
+        from .aio import asend_mass_mail
+        message = EmailMessage('mail_templated_test/multipart.html',
+                               {'name': gettext_lazy('content type')},
+                               'from@inter.net', ['to@inter.net'])
+        datatuple = [({'name': gettext_lazy('content type')},
+                      ['to%d@inter.net' % i]) for i in range(2)]
+        with translation.override('de'):
+            self._run(message.asend())
+            self._run(asend_mass_mail('mail_templated_test/multipart.html',
+                                      datatuple, 'from@inter.net'))
+        self.assertEqual([m.subject for m in mail.outbox],
+                         ['Hello Inhaltstyp'] * 3)
+
+    def test_asend_mail(self):
+        from .aio import asend_mail
+        connection = AsyncEmailBackend()
+        self.assertEqual(self._run(asend_mail(
+            'mail_templated_test/plain.tpl', {'name': 'User'},
+            'from@inter.net', ['to@inter.net'], connection=connection)), 1)
+        self.assertEqual(connection.async_count, 1)
+        self.assertEqual(mail.outbox[0].subject, 'Hello User')
+
+    def test_asend_mass_mail(self):
+        from .aio import asend_mass_mail
+        connection = CountingEmailBackend()
+        datatuple = (({'name': 'User%d' % i}, ['to%d@inter.net' % i])
+                     for i in range(5))
+        sent = self._run(asend_mass_mail(
+            'mail_templated_test/plain.tpl', datatuple, 'from@inter.net',
+            connection=connection, concurrency=2))
+        self.assertEqual(sent, 5)
+        self.assertEqual(connection.open_count, 1)
+        self.assertEqual(connection.close_count, 1)
+        self.assertEqual(sorted(m.subject for m in mail.outbox),
+                         ['Hello User%d' % i for i in range(5)])
+
+
+class FlakyEmailBackend(CountingEmailBackend):
+    """Locmem backend that fails with the specified errors first"""
+
+    def __init__(self, errors, *args, **kwargs):
+        super(FlakyEmailBackend, self).__init__(*args, **kwargs)
+        self.errors = list(errors)
+
+    def send_messages(self, messages):
+        # The None means success.
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+class DownEmailBackend(CountingEmailBackend):
+    """Locmem backend that can not connect to the server"""
+
+    def open(self):
+        super(DownEmailBackend, self).open()
+        raise smtplib.SMTPConnectError(421, 'Service not available')
+
+    def send_messages(self, messages):
+        self.open()
+
+
+class DispatcherTestCase(BaseMailTestCase):
+
+    def _messages(self, count):
+        return [EmailMessage('mail_templated_test/plain.tpl',
+                             {'name': 'User%d' % i}, 'from@inter.net',
+                             ['to%d@inter.net' % i]) for i in range(count)]
+
+    def test_dispatch(self):
+        from .dispatch import dispatch
+        connections = []
+
+        def get_connection():
+            connections.append(CountingEmailBackend())
+            return connections[-1]
+
+        stats = dispatch(self._messages(10), workers=3, queue_size=2,
+                         get_connection=get_connection)
+        self.assertEqual(stats['sent'], 10)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(len(connections), 3)
+        self.assertEqual([c.open_count for c in connections], [1, 1, 1])
+        self.assertEqual([c.close_count for c in connections], [1, 1, 1])
+        self.assertEqual(sorted(m.subject for m in mail.outbox),
+                         sorted('Hello User%d' % i for i in range(10)))
+
+    def test_retry(self):
+        from .dispatch import Dispatcher
+        connection = FlakyEmailBackend([
+            smtplib.SMTPServerDisconnected(),
+            smtplib.SMTPDataError(451, 'Try again later'),
+            smtplib.SMTPDataError(554, 'Rejected'),
+        ])
+        with Dispatcher(workers=1, retry_delay=0,
+                        get_connection=lambda: connection) as dispatcher:
+            for message in self._messages(2):
+                dispatcher.submit(message)
+        stats = dispatcher.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['retried']),
+                         (1, 1, 2))
+        self.assertEqual(len(dispatcher.errors), 1)
+        self.assertEqual(dispatcher.errors[0][1].smtp_code, 554)
+        self.assertEqual(connection.open_count, 3)
+
+    def test_connection_failed(self):
+        from .dispatch import dispatch
+        connections = []
+
+        def get_connection():
+            connections.append(DownEmailBackend())
+            return connections[-1]
+
+        stats = dispatch(self._messages(5), workers=2, queue_size=2,
+                         retries=1, retry_delay=0,
+                         get_connection=get_connection)
+        self.assertEqual((stats['sent'], stats['failed'], stats['retried']),
+                         (0, 5, 5))
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_transient_errors(self):
+        from .dispatch import is_transient_error
+        self.assertTrue(is_transient_error(smtplib.SMTPConnectError(421, '')))
+        self.assertTrue(is_transient_error(smtplib.SMTPRecipientsRefused(
+            {'to@inter.net': (450, 'Mailbox busy')})))
+        self.assertFalse(is_transient_error(smtplib.SMTPRecipientsRefused(
+            {'to@inter.net': (550, 'No such user')})))
+        self.assertFalse(is_transient_error(
+            smtplib.SMTPAuthenticationError(535, '')))
+        self.assertTrue(is_transient_error(IOError()))
+        self.assertFalse(is_transient_error(ValueError()))
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_run(self):
+        from .test_utils.benchmark import run_benchmarks
+        data = run_benchmarks(number=1, repeat=1)
+        self.assertIn('render.large', data['results'])
+        self.assertIn('send_mass_mail.100', data['results'])
+        self.assertTrue(all(result['seconds'] > 0
+                            for result in data['results'].values()))
+
+
+_metrics = []
+
+
+def _metrics_callback(**kwargs):
+    _metrics.append(kwargs)
+
+
+class InstrumentationTestCase(BaseMailTestCase):
+
+    def setUp(self):
+        self.timings = []
+        del _metrics[:]
+
+    def _receiver(self, sender, **kwargs):
+        self.timings.append(kwargs)
+
+    def _send(self):
+        message = EmailMessage('mail_templated_test/multipart.html',
+                               {'name': 'User'}, 'from@inter.net',
+                               ['to@inter.net'])
+        message.send()
+        return message
+
+    def test_signal(self):
+        timing.connect(self._receiver)
+        try:
+            message = self._send()
+        finally:
+            timing.disconnect(self._receiver)
+        self.assertEqual([t['stage'] for t in self.timings],
+                         ['load_template', 'render', 'extract', 'send'])
+        for t in self.timings:
+            self.assertIs(t['message'], message)
+            self.assertEqual(t['template_name'],
+                             'mail_templated_test/multipart.html')
+            self.assertTrue(t['duration'] >= 0)
+        self.assertTrue(self.timings[1]['size'] > self.timings[2]['size'])
+        self.assertEqual(self.timings[2]['size'], len(
+            'Hello UserUser, this is a plain text part.'
+            'User, this is an html part.'))
+        self.assertIsNone(self.timings[3]['size'])
+
+    def test_callback(self):
+        from django.test.utils import override_settings
+        with override_settings(
+                MAIL_TEMPLATED_METRICS_CALLBACK=_metrics_callback):
+            self._send()
+        self.assertEqual(len(_metrics), 4)
+        self.assertEqual(_metrics[0]['stage'], 'load_template')
+        self._send()
+        self.assertEqual(len(_metrics), 4)
+
+
+class WarmUpTestCase(TestCase):
+
+    email_templates = [
+        'mail_templated_test/base.tpl',
+        'mail_templated_test/empty.tpl',
+        'mail_templated_test/extended.tpl',
+        'mail_templated_test/large.html',
+        'mail_templated_test/multilang.tpl',
+        'mail_templated_test/multipart.html',
+        'mail_templated_test/overridden.tpl',
+        'mail_templated_test/overridden2.tpl',
+        'mail_templated_test/personalized.html',
+        'mail_templated_test/plain.html',
+        'mail_templated_test/plain.tpl',
+        'mail_templated_test/whitespaces.tpl',
+    ]
+
+    def setUp(self):
+        template_cache.clear()
+
+    def tearDown(self):
+        template_cache.clear()
+
+    def test_find_email_templates(self):
+        from .warmup import find_email_templates
+        self.assertEqual(find_email_templates(), self.email_templates)
+
+    def test_resolve(self):
+        from .warmup import resolve_template_names
+        self.assertEqual(
+            resolve_template_names(['mail_templated_test/plain.*',
+                                    'email/news.html']),
+            ['mail_templated_test/plain.html', 'mail_templated_test/plain.tpl',
+             'email/news.html'])
+        self.assertEqual(resolve_template_names('auto'),
+                         self.email_templates)
+
+    def test_warm_up(self):
+        from django.apps import apps
+        from django.test.utils import override_settings
+        with override_settings(
+                MAIL_TEMPLATED_TEMPLATE_CACHE_SIZE=100,
+                MAIL_TEMPLATED_WARMUP_TEMPLATES=['mail_templated_test/*.tpl']):
+            apps.get_app_config('mail_templated').ready()
+            self.assertEqual(template_cache.stats()['size'], 9)
+            EmailMessage('mail_templated_test/plain.tpl').load_template()
+            self.assertEqual(template_cache.stats()['hits'], 1)
+
+    def test_command(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        out = StringIO()
+        call_command('check_mail_templates', stdout=out)
+        self.assertIn('mail_templated_test/plain.tpl', out.getvalue())
+        self.assertIn('12 templates checked, 0 errors.', out.getvalue())
+        self.assertRaises(CommandError, call_command, 'check_mail_templates',
+                          'mail_templated_test/no.tpl', stdout=StringIO())
+
+
+class PayloadTestCase(BaseMailTestCase):
+
+    def _message(self):
+        message = EmailMessage(
+            'mail_templated_test/multipart.html', {'name': 'User'},
+            'from@inter.net', ['to@inter.net'], cc=['cc@inter.net'],
+            headers={'X-Campaign': 'news'})
+        message.attach('note.txt', 'Some text', 'text/plain')
+        message.attach('data.bin', b'\x00\xff', 'application/octet-stream')
+        return message
+
+    def test_round_trip(self):
+        import json
+        message = self._message()
+        data = json.loads(json.dumps(message.to_payload()))
+        self.assertTrue(message.is_rendered)
+        self.assertNotIn('context', data)
+        restored = EmailMessage.from_payload(data)
+        self.assertTrue(restored.is_rendered)
+        self._assertMessageClean(restored, True)
+        for name in ('subject', 'body', 'from_email', 'to', 'cc', 'bcc',
+                     'extra_headers', 'content_subtype'):
+            self.assertEqual(getattr(restored, name), getattr(message, name))
+        self.assertEqual([tuple(a) for a in restored.alternatives],
+                         [tuple(a) for a in message.alternatives])
+        self.assertEqual([tuple(a) for a in restored.attachments],
+                         [tuple(a) for a in message.attachments])
+        self.assertEqual(restored.send(), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Hello User')
+
+    def test_mime_attachment(self):
+        import json
+        from email.mime.base import MIMEBase
+        from email.mime.text import MIMEText
+        message = self._message()
+        part = MIMEText('Mime text', 'plain', 'utf-8')
+        part.add_header('Content-Disposition', 'attachment',
+                        filename='mime.txt')
+        message.attach(part)
+        data = json.loads(json.dumps(message.to_payload()))
+        restored = EmailMessage.from_payload(data)
+        attachment = restored.attachments[-1]
+        self.assertIsInstance(attachment, MIMEBase)
+        self.assertEqual(attachment.get_filename(), 'mime.txt')
+        self.assertEqual(attachment.get_payload(decode=True), b'Mime text')
+        self.assertEqual(restored.send(), 1)
+        self.assertIn('filename="mime.txt"',
+                      mail.outbox[0].message().as_string())
+
+    def test_unsupported_version(self):
+        data = self._message().to_payload()
+        data['version'] = 0
+        self.assertRaises(ValueError, EmailMessage.from_payload, data)
+
+    def test_deferred(self):
+        import json
+        from django.contrib.contenttypes.models import ContentType
+        types = list(ContentType.objects.all()[:2])
+        messages = [EmailMessage('mail_templated_test/multipart.html',
+                                 {'name': content_type}, 'from@inter.net',
+                                 ['to@inter.net'])
+                    for content_type in types]
+        with translation.override('de'):
+            data = [json.loads(json.dumps(message.to_payload(deferred=True)))
+                    for message in messages]
+        self.assertEqual(data[0]['language'], 'de')
+        self.assertEqual(data[0]['context']['name']['__model__'],
+                         'contenttypes.ContentType')
+        self.assertFalse(messages[0].is_rendered)
+        with self.assertNumQueries(1):
+            restored = EmailMessage.from_payloads(data)
+        for message, content_type in zip(restored, types):
+            self.assertTrue(message.is_rendered)
+            self._assertMessageClean(message, True)
+            # The message is rendered in the language of the producer.
+            with translation.override('de'):
+                self.assertEqual(message.subject, 'Hello %s' % content_type)
+            self.assertEqual(message.to, ['to@inter.net'])
+
+    def test_deferred_errors(self):
+        from django.contrib.contenttypes.models import ContentType
+        message = EmailMessage('mail_templated_test/plain.tpl', {},
+                               render=True)
+        self.assertRaises(ValueError, message.to_payload, deferred=True)
+        content_type = ContentType.objects.all()[0]
+        data = EmailMessage('mail_templated_test/plain.tpl',
+                            {'name': content_type}).to_payload(deferred=True)
+        content_type.delete()
+        self.assertRaises(ContentType.DoesNotExist, EmailMessage.from_payload,
+                          data)
+
+
+class QuerysetMessagesTestCase(BaseMailTestCase):
+
+    def _messages(self, relations=()):
+        from django.contrib.auth.models import Permission
+        batches = []
+        messages = list(iter_queryset_messages(
+            'mail_templated_test/plain.tpl', Permission.objects.all(),
+            lambda permission: ({'name': permission.content_type.model},
+                                ['%s@inter.net' % permission.codename]),
+            'from@inter.net', relations=relations, batch_size=3,
+            on_batch=batches.append))
+        return messages, batches
+
+    def test_messages(self):
+        from django.contrib.auth.models import Permission
+        permissions = list(Permission.objects.order_by('pk'))
+        messages, batches = self._messages(['content_type'])
+        self.assertEqual(len(messages), len(permissions))
+        for message, permission in zip(messages, permissions):
+            self.assertTrue(message.is_rendered)
+            self.assertEqual(message.to, ['%s@inter.net' % permission.codename])
+            self.assertEqual(message.subject,
+                             'Hello %s' % permission.content_type.model)
+        self.assertEqual([batch['batch'] for batch in batches],
+                         list(range(1, len(batches) + 1)))
+        self.assertEqual(sum(batch['size'] for batch in batches),
+                         len(permissions))
+
+    def test_query_count(self):
+        from django.db import connection
+        if not hasattr(connection, 'execute_wrapper'):
+            self.skipTest('Query counting requires Django 2.0 or later.')
+        from django.contrib.contenttypes.models import ContentType
+        ContentType.objects.clear_cache()
+        _, batches = self._messages()
+        self.assertEqual(batches[0]['queries'], 4)
+        _, batches = self._messages(['content_type'])
+        self.assertEqual(batches[0]['queries'], 2)
+
+
+def upper_html(html):
+    upper_html.calls += 1
+    return html.upper()
+
+upper_html.calls = 0
+
+
+class HtmlProcessorsTestCase(BaseMailTestCase):
+
+    def test_minify(self):
+        from .processors import minify_html
+        html = ('<html>\n  <head>\n    <style>\n  p { color: red; }\n'
+                '</style>\n  </head>\n  <body>  <!-- comment -->\n'
+                '<!--[if mso]>  <table> <![endif]-->\n'
+                '    <p>Hello   World</p>\n<pre>  a\n    b</pre>  \n'
+                '</body>\n</html>\n')
+        self.assertEqual(
+            minify_html(html),
+            '<html>\n<head>\n<style>\n  p { color: red; }\n</style>\n'
+            '</head>\n<body>\n<!--[if mso]>  <table> <![endif]-->\n'
+            '<p>Hello World</p>\n<pre>  a\n    b</pre>\n</body>\n</html>')
+
+    def test_minify_attributes(self):
+        from .processors import minify_html
+        html = ('<img  src="a.png"\n     alt="a   b" title=\'c\n  d\'>  '
+                '<a href="/" title="x > y">  It\'s   here  </a>')
+        self.assertEqual(
+            minify_html(html),
+            '<img src="a.png"\nalt="a   b" title=\'c\n  d\'> '
+            '<a href="/" title="x > y"> It\'s here </a>')
+
+    def test_inline_css(self):
+        from django.test.utils import override_settings
+        from .processors import inline_css
+        self.assertEqual(inline_css('<p>Hello</p>'), '<p>Hello</p>')
+        with override_settings(
+                MAIL_TEMPLATED_CSS_INLINER='mail_templated.tests.upper_html'):
+            self.assertEqual(inline_css('<p>Hello</p>'), '<P>HELLO</P>')
+
+    def test_pipeline(self):
+        from django.test.utils import override_settings
+        upper_html.calls = 0
+        with override_settings(MAIL_TEMPLATED_HTML_PROCESSORS=[
+                'mail_templated.processors.minify_html', upper_html]):
+            for i in range(3):
+                message = EmailMessage('mail_templated_test/multipart.html',
+                                       {'name': 'User'}, render=True)
+                self.assertEqual(message.alternatives[0][0],
+                                 'USER, THIS IS AN HTML PART.')
+                self.assertEqual(message.body,
+                                 'User, this is a plain text part.')
+        # The identical html is processed only once.
+        self.assertEqual(upper_html.calls, 1)
+
+
+class PlainTextTestCase(BaseMailTestCase):
+
+    def test_html_to_text(self):
+        from .text import html_to_text
+        html = ('<html><head><title>Title</title>'
+                '<style>p { color: red; }</style></head><body>\n'
+                '<h1>Hello  &amp; welcome</h1>\n'
+                '<p>Some <b>bold</b> text,<br>new line. '
+                '<a href="https://inter.net/a">Click here</a>.</p>\n'
+                '<ul><li>One</li><li>Two</li></ul>\n'
+                '<table><tr><td>A</td><td>B</td></tr></table>\n'
+                '<pre>  x\n  y</pre><img src="logo.png" alt="Logo"> end\n'
+                '</body></html>')
+        self.assertEqual(
+            html_to_text(html),
+            'Hello & welcome\n\nSome bold text,\nnew line. Click here '
+            '(https://inter.net/a).\n\n* One\n* Two\n\nA B\n\n  x\n'
+            '  y\n\nLogo end')
+
+    def test_disabled(self):
+        message = EmailMessage('mail_templated_test/plain.html',
+                               {'name': 'User'}, render=True)
+        self.assertEqual(message.content_subtype, 'html')
+        self.assertEqual(message.alternatives, [])
+
+    def test_enabled(self):
+        from django.test.utils import override_settings
+        from .text import text_cache
+        with override_settings(MAIL_TEMPLATED_PLAIN_TEXT_FROM_HTML=True):
+            for i in range(2):
+                message = EmailMessage('mail_templated_test/plain.html',
+                                       {'name': 'User'}, render=True)
+                self.assertEqual(message.content_subtype, 'plain')
+                self.assertEqual(message.body,
+                                 'User, this is an html message.')
+                self.assertEqual(message.alternatives[0][1], 'text/html')
+                self.assertEqual(message.alternatives[0][0],
+                                 'User, this is an html message.')
+            self.assertEqual(text_cache.stats()['hits'], 1)
+            # The body block is used if it exists.
+            message = EmailMessage('mail_templated_test/multipart.html',
+                                   {'name': 'User'}, render=True)
+            self.assertEqual(message.body, 'User, this is a plain text part.')
+
+
+class LocalizedTestCase(BaseMailTestCase):
+
+    def _datatuple(self):
+        return [({'name': 'User%d' % i}, ['to%d@inter.net' % i], language)
+                for i, language in enumerate(['de', 'en', 'de', None])]
+
+    def test_grouped_by_language(self):
+        from django.utils.translation import gettext_lazy
+        translation.activate('en')
+        try:
+            messages = list(iter_localized_messages(
+                'mail_templated_test/multipart.html',
+                [({'name': gettext_lazy('content type')}, to, language)
+                 for _, to, language in self._datatuple()],
+                'from@inter.net'))
+        finally:
+            translation.deactivate()
+        self.assertEqual([message.to for message in messages],
+                         [['to0@inter.net'], ['to2@inter.net'],
+                          ['to1@inter.net'], ['to3@inter.net']])
+        self.assertEqual([message.subject for message in messages],
+                         ['Hello Inhaltstyp', 'Hello Inhaltstyp',
+                          'Hello content type', 'Hello content type'])
+        self._assertMessageClean(messages[0], True)
+
+    def test_language_restored(self):
+        with translation.override('en'):
+            messages = iter_localized_messages(
+                'mail_templated_test/plain.tpl', self._datatuple(),
+                'from@inter.net')
+            for message in messages:
+                self.assertEqual(translation.get_language(), 'en')
+            self.assertEqual(translation.get_language(), 'en')
+
+    def test_shared_context(self):
+        from django.utils.translation import gettext_lazy
+        messages = list(iter_localized_messages(
+            'mail_templated_test/personalized.html',
+            [({'name': 'User%d' % i, 'unsubscribe_url': '/u/'}, to, language)
+             for i, (_, to, language) in enumerate(self._datatuple())],
+            'from@inter.net',
+            shared_context={'title': gettext_lazy('content type'),
+                            'text': ''}))
+        self.assertEqual(messages[0].subject, 'Inhaltstyp for User0')
+        self.assertEqual(messages[1].subject, 'Inhaltstyp for User2')
+
+    def test_send(self):
+        sent = send_localized_mail('mail_templated_test/plain.tpl',
+                                   self._datatuple(), 'from@inter.net')
+        self.assertEqual(sent, 4)
+        self.assertEqual(len(mail.outbox), 4)
+
+
+class FileAttachmentTestCase(BaseMailTestCase):
+
+    def setUp(self):
+        self.file_name = os.path.join(os.path.dirname(__file__), 'test_utils',
+                                      'attachment.png')
+        with open(self.file_name, 'rb') as f:
+            self.content = f.read()
+
+    def _message(self, **kwargs):
+        return EmailMessage('mail_templated_test/plain.tpl', {'name': 'User'},
+                            'from@inter.net', ['to@inter.net'], **kwargs)
+
+    def _assertAttached(self, message, content, mimetype):
+        parts = [part for part in message.message().walk()
+                 if part.get_filename()]
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(parts[0].get_content_type(), mimetype)
+        self.assertEqual(parts[0].get_payload(decode=True), content)
+
+    def test_same_as_eager(self):
+        from .attachments import FileContent
+        message = self._message()
+        message.attach_file(self.file_name, lazy=True)
+        filename, content, mimetype = message.attachments[0]
+        self.assertEqual((filename, mimetype), ('attachment.png', 'image/png'))
+        self.assertIsInstance(content, FileContent)
+        self._assertAttached(message, self.content, 'image/png')
+        eager = self._message()
+        eager.attach_file(self.file_name)
+        self._assertAttached(eager, self.content, 'image/png')
+
+    def test_read_on_sending(self):
+        from .attachments import file_attachment
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'note.txt')
+            with open(path, 'wb') as f:
+                f.write(b'First')
+            attachment = file_attachment(path)
+            messages = [self._message(attachments=[attachment])
+                        for i in range(2)]
+            self.assertIs(messages[0].attachments[0][1],
+                          messages[1].attachments[0][1])
+            with open(path, 'wb') as f:
+                f.write(b'Second')
+            self._assertAttached(messages[0], b'Second', 'text/plain')
+            with open(path, 'wb') as f:
+                f.write(b'\xff\xfe')
+            self._assertAttached(messages[1], b'\xff\xfe',
+                                 'application/octet-stream')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_serialization(self):
+        message = self._message()
+        message.attach_file(self.file_name, lazy=True)
+        message.render()
+        self.assertNotIn(self.content, pickle.dumps(message))
+        restored = pickle.loads(pickle.dumps(message))
+        self._assertAttached(restored, self.content, 'image/png')
+        data = message.to_payload()
+        self.assertEqual(data['attachments'][0]['path'], self.file_name)
+        restored = EmailMessage.from_payload(data)
+        self._assertAttached(restored, self.content, 'image/png')
+
+
+class AttachmentCacheTestCase(BaseMailTestCase):
+
+    def setUp(self):
+        from .attachments import attachment_cache
+        self.cache = attachment_cache
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def _parts(self, content=b'\x00' * 1000):
+        message = EmailMessage('mail_templated_test/plain.tpl',
+                               {'name': 'User'}, 'from@inter.net',
+                               ['to@inter.net'])
+        message.attach('data.bin', content, 'application/octet-stream')
+        message.attach('note.txt', 'Some text', 'text/plain')
+        return [part for part in message.message().walk()
+                if part.get_filename()]
+
+    def test_disabled(self):
+        self._parts()
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_enabled(self):
+        from django.test.utils import override_settings
+        expected = [part.as_string() for part in self._parts()]
+        with override_settings(MAIL_TEMPLATED_ATTACHMENT_CACHE_SIZE=10):
+            for i in range(3):
+                parts = self._parts()
+                self.assertEqual([part.as_string() for part in parts],
+                                 expected)
+                # The cached parts are not affected by changes of the copies.
+                parts[0]['X-Changed'] = 'yes'
+            self.assertEqual(self.cache.stats()['hits'], 4)
+            self.assertEqual(self.cache.stats()['size'], 2)
+            self._parts(b'\x01' * 1000)
+            self.assertEqual(self.cache.stats()['size'], 3)
+
+
+class MimeSkeletonTestCase(BaseMailTestCase):
+
+    def setUp(self):
+        from .mime import skeleton_cache
+        self.cache = skeleton_cache
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def _message(self, i):
+        message = EmailMessage(
+            'mail_templated_test/multipart.html', {'name': 'User%d' % i},
+            'from@inter.net', ['to%d@inter.net' % i],
+            headers={'Date': 'Tue, 01 Nov 2016 12:00:00 -0000',
+                     'Message-ID': '<%d@inter.net>' % i}, render=True)
+        message.attach('data.bin', b'\x00' * 1000, 'application/octet-stream')
+        return message
+
+    def _boundaries(self, msg):
+        return [part.get_boundary() for part in msg.walk()
+                if part.is_multipart()]
+
+    def test_same_as_django(self):
+        from django.test.utils import override_settings
+        with override_settings(MAIL_TEMPLATED_MIME_SKELETON_CACHE_SIZE=10):
+            self._message(0).message()
+            msgs = [self._message(i).message() for i in range(1, 3)]
+            self.assertEqual(self.cache.stats()['hits'], 2)
+        # The boundaries are generated only once for the shape.
+        boundaries = self._boundaries(msgs[0])
+        self.assertEqual(len(boundaries), 2)
+        self.assertNotIn(None, boundaries)
+        self.assertEqual(self._boundaries(msgs[1]), boundaries)
+        for i, msg in enumerate(msgs, 1):
+            expected = self._message(i).message()
+            for part, boundary in zip(
+                    [part for part in expected.walk() if part.is_multipart()],
+                    boundaries):
+                part.set_boundary(boundary)
+            self.assertEqual(msg.as_bytes(), expected.as_bytes())
+
+    def test_boundary_collision(self):
+        from django.test.utils import override_settings
+        with override_settings(MAIL_TEMPLATED_MIME_SKELETON_CACHE_SIZE=10):
+            self._message(0).message()
+            boundary = list(self.cache._data.values())[0][0].mixed \
+                .get_boundary()
+            message = self._message(1)
+            message.body = boundary
+            msg = message.message()
+        self.assertEqual(self._boundaries(msg), [None, None])
+        self.assertIn(boundary, msg.as_string())
+
+    def test_different_shapes(self):
+        from django.test.utils import override_settings
+        with override_settings(MAIL_TEMPLATED_MIME_SKELETON_CACHE_SIZE=10):
+            self._message(0).message()
+            message = self._message(1)
+            message.attachments = []
+            message.message()
+            EmailMessage('mail_templated_test/plain.tpl', {'name': 'User'},
+                         render=True).message()
+            self.assertEqual(self.cache.stats()['size'], 2)
+            self.assertEqual(self.cache.stats()['hits'], 0)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SchedulerTestCase(BaseMailTestCase):
+
+    def _messages(self, domains):
+        self.rendered = 0
+
+        def iter_messages():
+            for i, domain in enumerate(domains):
+                self.rendered += 1
+                yield EmailMessage('mail_templated_test/plain.tpl',
+                                   {'name': 'User%d' % i}, 'from@inter.net',
+                                   ['User <to%d@%s>' % (i, domain)])
+
+        return iter_messages()
+
+    def _scheduler(self, **kwargs):
+        from .throttle import Scheduler
+        self.clock = FakeClock()
+        self.connection = CountingEmailBackend()
+        return Scheduler(connection=self.connection, clock=self.clock,
+                         sleep=self.clock.sleep, **kwargs)
+
+    def test_token_bucket(self):
+        from .throttle import TokenBucket
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=2, clock=clock)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0.5)
+        self.assertEqual(bucket.consume(), 1.0)
+        clock.sleep(1.0)
+        self.assertEqual(bucket.consume(), 0.5)
+
+    def test_global_rate(self):
+        scheduler = self._scheduler(rate=10)
+        stats = scheduler.send(self._messages(['inter.net'] * 5))
+        self.assertEqual(stats['sent'], 5)
+        self.assertAlmostEqual(stats['throttled'], 0.4)
+        self.assertAlmostEqual(self.clock.now, 0.4)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_domain_rate(self):
+        scheduler = self._scheduler(domain_rate=1)
+        stats = scheduler.send(self._messages(
+            ['inter.net', 'Example.com', 'inter.net', 'example.com']))
+        self.assertEqual(stats['sent'], 4)
+        # The second messages to each domain wait for a second.
+        self.assertAlmostEqual(stats['throttled'], 1.0)
+        self.assertEqual(sorted(scheduler.domain_buckets),
+                         ['example.com', 'inter.net'])
+
+    def test_backpressure(self):
+        scheduler = self._scheduler(rate=1)
+        messages = self._messages(['inter.net'] * 3)
+        sleep = scheduler.sleep
+
+        def check_sleep(seconds):
+            # Only the message that waits for sending is rendered.
+            self.assertEqual(self.rendered, len(mail.outbox) + 1)
+            sleep(seconds)
+
+        scheduler.sleep = check_sleep
+        scheduler.send(messages)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_connection_rotation(self):
+        scheduler = self._scheduler(messages_per_connection=2)
+        stats = scheduler.send(self._messages(['inter.net'] * 5))
+        self.assertEqual(stats['connections'], 3)
+        self.assertEqual(self.connection.open_count, 3)
+        self.assertEqual(self.connection.close_count, 3)
+        self.assertEqual(stats['throttled'], 0)
+
+    def test_retry(self):
+        from .throttle import Scheduler
+        clock = FakeClock()
+        connection = FlakyEmailBackend([
+            smtplib.SMTPDataError(451, 'Try again later')])
+        stats = Scheduler(rate=1, retry_delay=1, connection=connection,
+                          clock=clock, sleep=clock.sleep).send(
+            self._messages(['inter.net'] * 2))
+        self.assertEqual((stats['sent'], stats['retried']), (2, 1))
+        self.assertEqual(connection.open_count, 2)
+
+    def test_failures(self):
+        from .throttle import Scheduler
+        connection = FlakyEmailBackend([
+            smtplib.SMTPRecipientsRefused(
+                {'to0@inter.net': (550, 'No such user')}),
+            smtplib.SMTPDataError(451, 'Try again later'),
+            smtplib.SMTPDataError(451, 'Try again later'),
+        ])
+        scheduler = Scheduler(retries=1, retry_delay=0, connection=connection)
+        stats = scheduler.send(self._messages(['inter.net'] * 4))
+        self.assertEqual((stats['sent'], stats['failed'], stats['retried']),
+                         (2, 2, 1))
+        self.assertEqual([message.to for message, _ in scheduler.errors],
+                         [['User <to0@inter.net>'], ['User <to1@inter.net>']])
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_retry_resets_rotation(self):
+        from .throttle import Scheduler
+        connection = FlakyEmailBackend([
+            None, smtplib.SMTPDataError(451, 'Try again later')])
+        stats = Scheduler(messages_per_connection=2, retry_delay=0,
+                          connection=connection).send(
+            self._messages(['inter.net'] * 3))
+        self.assertEqual((stats['sent'], stats['retried']), (3, 1))
+        # The second connection is opened on retry, and it is used for two
+        # messages.
+        self.assertEqual(stats['connections'], 2)
+
+    def test_retry_domain_rate(self):
+        from .throttle import Scheduler
+        clock = FakeClock()
+        connection = FlakyEmailBackend([
+            smtplib.SMTPDataError(451, 'Try again later')])
+        stats = Scheduler(domain_rate=1, retry_delay=0, connection=connection,
+                          clock=clock, sleep=clock.sleep).send(
+            self._messages(['inter.net']))
+        self.assertEqual((stats['sent'], stats['retried']), (1, 1))
+        self.assertAlmostEqual(stats['throttled'], 1.0)
+
+    def test_reconnect_failed(self):
+        from .throttle import Scheduler
+        connection = FlakyEmailBackend([
+            smtplib.SMTPDataError(451, 'Try again later')])
+        open_errors = [None, smtplib.SMTPConnectError(421, 'Busy')]
+
+        def open():
+            connection.open_count += 1
+            error = open_errors.pop(0) if open_errors else None
+            if error is not None:
+                raise error
+
+        connection.open = open
+        stats = Scheduler(retries=2, retry_delay=0, connection=connection).send(
+            self._messages(['inter.net'] * 2))
+        self.assertEqual((stats['sent'], stats['failed'], stats['retried']),
+                         (2, 0, 2))
+        self.assertEqual((stats['connections'], connection.open_count), (2, 3))
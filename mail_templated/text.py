@@ -0,0 +1,190 @@
+"""
+.. module:: mail_templated.text
+   :synopsis: Conversion of the html part to plain text.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import hashlib
+
+from django.test.signals import setting_changed
+
+from .cache import LRUCache
+from .conf import app_settings, get_callable
+
+try:
+    from html.parser import HTMLParser
+    from html import unescape
+except ImportError:
+    # Python 2
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+
+# The elements that are separated with a blank line.
+PARAGRAPH_TAGS = frozenset([
+    'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'pre',
+    'table', 'ul',
+])
+
+# The elements that start from a new line.
+BLOCK_TAGS = frozenset([
+    'address', 'article', 'aside', 'dd', 'div', 'dl', 'dt', 'fieldset',
+    'figcaption', 'figure', 'footer', 'form', 'header', 'hr', 'li', 'main',
+    'nav', 'section', 'tbody', 'tfoot', 'thead', 'tr',
+])
+
+# The elements that are not displayed.
+SKIP_TAGS = frozenset(['head', 'script', 'style', 'template', 'title'])
+
+
+class HtmlToText(HTMLParser):
+    """
+    Convert html to readable plain text in a single pass.
+
+    The whitespace is collapsed like in a browser, the block elements are
+    separated with line breaks, the list items are prefixed with ``*``, and
+    the link addresses are added after the link texts. The content of the
+    ``head``, ``script`` and ``style`` elements is skipped.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.chunks = []
+        self.breaks = 0
+        self.space = False
+        self.skip = 0
+        self.pre = 0
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip += 1
+            return
+        if tag == 'br':
+            self.breaks += 1
+        elif tag in PARAGRAPH_TAGS:
+            self._break(2)
+        elif tag in BLOCK_TAGS:
+            self._break(1)
+        elif tag in ('td', 'th'):
+            self.space = True
+        if tag == 'pre':
+            self.pre += 1
+        elif tag == 'li':
+            self._write('* ')
+        elif tag == 'img':
+            alt = dict(attrs).get('alt')
+            if alt:
+                self.handle_data(alt)
+        elif tag == 'a':
+            self.links.append((dict(attrs).get('href'), len(self.chunks)))
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+            return
+        if tag == 'pre':
+            self.pre = max(self.pre - 1, 0)
+        elif tag == 'a' and self.links:
+            href, index = self.links.pop()
+            text = ''.join(self.chunks[index:]).strip()
+            if href and href != text and not href.startswith(
+                    ('#', 'mailto:', 'javascript:')):
+                self._write('(%s)' % href if text else href, True)
+        if tag in PARAGRAPH_TAGS:
+            self._break(2)
+        elif tag in BLOCK_TAGS:
+            self._break(1)
+
+    def handle_data(self, data):
+        if self.skip or not data:
+            return
+        if self.pre:
+            self._write(data)
+            return
+        text = ' '.join(data.split())
+        if data[0].isspace():
+            self.space = True
+        if text:
+            self._write(text)
+            self.space = data[-1].isspace()
+
+    def handle_entityref(self, name):
+        # Python 2 does not convert the references automatically.
+        self.handle_data(unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(unescape('&#%s;' % name))
+
+    def get_text(self):
+        return ''.join(self.chunks).strip()
+
+    def _break(self, count):
+        self.breaks = max(self.breaks, count)
+
+    def _write(self, text, space=False):
+        if self.chunks:
+            if self.breaks:
+                self.chunks.append('\n' * self.breaks)
+            elif ((self.space or space) and
+                  not self.chunks[-1].endswith((' ', '\n'))):
+                self.chunks.append(' ')
+        self.breaks = 0
+        self.space = False
+        self.chunks.append(text)
+
+
+def html_to_text(html):
+    """
+    Convert html to plain text with :class:`HtmlToText`.
+    """
+    parser = HtmlToText()
+    parser.feed(html)
+    parser.close()
+    return parser.get_text()
+
+
+class TextCache(LRUCache):
+    """
+    Cache of the plain text generated from html.
+
+    It is configured with the ``MAIL_TEMPLATED_PLAIN_TEXT_CACHE_SIZE``
+    setting.
+    """
+
+    def __init__(self):
+        super(TextCache, self).__init__(0)
+
+    @property
+    def max_size(self):
+        return app_settings.PLAIN_TEXT_CACHE_SIZE
+
+
+text_cache = TextCache()
+
+
+def get_plain_text(html):
+    """
+    Get the plain text for the html part with the converter specified by the
+    ``MAIL_TEMPLATED_PLAIN_TEXT_FROM_HTML`` setting.
+
+    The result is cached by the hash of the html, so the identical html is
+    converted only once.
+    """
+    converter = app_settings.PLAIN_TEXT_FROM_HTML
+    converter = html_to_text if converter is True else get_callable(converter)
+    key = hashlib.sha1(html.encode('utf-8')).hexdigest()
+    text = text_cache.get(key)
+    if text is None:
+        text = converter(html)
+        text_cache.set(key, text)
+    return text
+
+
+def _clear_cache(**kwargs):
+    if kwargs['setting'].startswith('MAIL_TEMPLATED_PLAIN_TEXT_'):
+        text_cache.clear()
+
+
+setting_changed.connect(_clear_cache)
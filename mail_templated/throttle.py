@@ -0,0 +1,285 @@
+"""
+.. module:: mail_templated.throttle
+   :synopsis: Rate limited sending of email messages.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import threading
+import time
+from email.utils import parseaddr
+from timeit import default_timer
+
+from django.core import mail
+
+from .conf import app_settings
+from .dispatch import is_transient_error
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket rate limiter.
+
+    The bucket is refilled with ``rate`` tokens per second up to ``burst``
+    tokens. Every message takes a token. The tokens are reserved even if they
+    are not available yet, and the caller should wait for the returned delay.
+
+    Arguments
+    ---------
+    rate : float
+        The number of tokens per second.
+
+    Keyword Arguments
+    -----------------
+    burst : int
+        The maximum number of tokens. Default is ``1``.
+    clock : callable
+        The function that returns the current time in seconds.
+    """
+
+    def __init__(self, rate, burst=1, clock=default_timer):
+        self.rate = float(rate)
+        self.burst = max(burst or 1, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """
+        Take the tokens.
+
+        Returns
+        -------
+        float
+            The number of seconds to wait until the tokens are available, ``0``
+            if they are available now.
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class Scheduler(object):
+    """
+    Send email messages not faster than the email server allows.
+
+    The messages are sent over a single connection with a global rate limit
+    and a rate limit per recipient domain. The messages are taken from the
+    iterable one by one, and the next message is taken only after the previous
+    one is sent. This way the lazy rendering helpers like
+    :func:`~mail_templated.iter_rendered_messages()` do not render the
+    messages faster than they are sent, and the messages that are not rendered
+    yet are rendered just before sending. The connection is reopened after
+    the specified number of messages.
+
+    The temporary errors (see
+    :func:`~mail_templated.dispatch.is_transient_error`) are retried with a new
+    connection and exponential delay, and the retries are rate limited too.
+    The messages that can not be sent are recorded in :attr:`errors`, and the
+    sending continues with the next message.
+
+    Keyword Arguments
+    -----------------
+    rate : float
+        The maximum number of messages per second. Defaults to the
+        ``MAIL_TEMPLATED_THROTTLE_RATE`` setting. ``None`` means unlimited.
+    domain_rate : float
+        The maximum number of messages per second for each recipient domain.
+        Defaults to the ``MAIL_TEMPLATED_THROTTLE_DOMAIN_RATE`` setting.
+        ``None`` means unlimited.
+    burst : int
+        The number of messages that can be sent at once before the rate limit
+        applies. Defaults to the ``MAIL_TEMPLATED_THROTTLE_BURST`` setting.
+    messages_per_connection : int
+        The number of messages after that the connection is reopened. Defaults
+        to the ``MAIL_TEMPLATED_THROTTLE_MESSAGES_PER_CONNECTION`` setting.
+        ``None`` means never.
+    retries : int
+        The maximum number of retries on temporary errors. Defaults to the
+        ``MAIL_TEMPLATED_DISPATCH_RETRIES`` setting.
+    retry_delay : float
+        The delay before the first retry in seconds. Defaults to the
+        ``MAIL_TEMPLATED_DISPATCH_RETRY_DELAY`` setting.
+    connection : EmailBackend
+        The connection to use. Defaults to a new connection of the default
+        backend.
+    clock : callable
+        The function that returns the current time in seconds.
+    sleep : callable
+        The function that waits for the specified number of seconds.
+    """
+
+    def __init__(self, rate=None, domain_rate=None, burst=None,
+                 messages_per_connection=None, retries=None, retry_delay=None,
+                 connection=None, clock=default_timer, sleep=time.sleep):
+        rate = app_settings.THROTTLE_RATE if rate is None else rate
+        self.domain_rate = (app_settings.THROTTLE_DOMAIN_RATE
+                            if domain_rate is None else domain_rate)
+        self.burst = burst or app_settings.THROTTLE_BURST
+        self.messages_per_connection = (
+            messages_per_connection or
+            app_settings.THROTTLE_MESSAGES_PER_CONNECTION)
+        self.retries = (app_settings.DISPATCH_RETRIES if retries is None
+                        else retries)
+        self.retry_delay = (app_settings.DISPATCH_RETRY_DELAY
+                            if retry_delay is None else retry_delay)
+        self.connection = connection or mail.get_connection()
+        self.clock = clock
+        self.sleep = sleep
+        self.bucket = TokenBucket(rate, self.burst, clock) if rate else None
+        self.domain_buckets = {}
+        #: The list of ``(message, exception)`` pairs for failed messages.
+        self.errors = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.connections = 0
+        self.throttled = 0.0
+        self._started = self._finished = None
+        self._is_open = False
+        # The number of messages sent over the current connection.
+        self._opened = 0
+
+    def send(self, messages):
+        """
+        Send the messages.
+
+        Arguments
+        ---------
+        messages : iterable
+            Email messages to send. It may be a generator, it is consumed
+            lazily.
+
+        Returns
+        -------
+        dict
+            See :meth:`stats()`.
+        """
+        self._started = self.clock()
+        try:
+            for message in messages:
+                self._throttle(message)
+                if self.messages_per_connection and \
+                        self._opened >= self.messages_per_connection:
+                    self._close()
+                self._send(message)
+                self._opened += 1
+        finally:
+            if self._is_open:
+                self._close()
+            self._finished = self.clock()
+        return self.stats()
+
+    def stats(self):
+        """
+        Get the aggregate statistics.
+
+        Returns
+        -------
+        dict
+            The numbers of ``sent``, ``failed`` and ``retried`` messages, the
+            number of opened ``connections``, the ``throttled`` time spent
+            waiting for the rate limits and the ``elapsed`` time in seconds.
+        """
+        elapsed = 0
+        if self._started is not None:
+            elapsed = (self._finished or self.clock()) - self._started
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'connections': self.connections,
+            'throttled': self.throttled,
+            'elapsed': elapsed,
+        }
+
+    def _throttle(self, message):
+        delay = self._consume_domains(message)
+        if self.bucket:
+            delay = max(delay, self.bucket.consume())
+        self._wait(delay)
+
+    def _consume_domains(self, message):
+        if not self.domain_rate:
+            return 0.0
+        domains = set(parseaddr(address)[1].rpartition('@')[2].lower()
+                      for address in message.recipients())
+        delay = 0.0
+        for domain in domains:
+            bucket = self.domain_buckets.get(domain)
+            if bucket is None:
+                bucket = self.domain_buckets[domain] = TokenBucket(
+                    self.domain_rate, self.burst, self.clock)
+            delay = max(delay, bucket.consume())
+        return delay
+
+    def _wait(self, delay):
+        if delay > 0:
+            self.throttled += delay
+            self.sleep(delay)
+
+    def _open(self):
+        self.connection.open()
+        self._is_open = True
+        self._opened = 0
+        self.connections += 1
+
+    def _close(self):
+        self._is_open = False
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+    def _send(self, message):
+        attempt = 0
+        while True:
+            try:
+                # A failed connection is retried like a failed sending.
+                if not self._is_open:
+                    self._open()
+                if not getattr(message, 'is_rendered', True):
+                    message.render()
+                sent = self.connection.send_messages([message]) or 0
+            except Exception as exc:
+                if attempt < self.retries and is_transient_error(exc):
+                    attempt += 1
+                    self.retried += 1
+                    self._close()
+                    self.sleep(self.retry_delay * 2 ** (attempt - 1))
+                    self._throttle(message)
+                    continue
+                self.failed += 1
+                self.errors.append((message, exc))
+                return
+            if sent:
+                self.sent += sent
+            else:
+                self.failed += 1
+            return
+
+
+def send_throttled(messages, **kwargs):
+    """
+    Send the messages with a :class:`Scheduler`.
+
+    Arguments
+    ---------
+    messages : iterable
+        Email messages to send. It may be a generator, it is consumed lazily.
+
+    Keyword arguments are passed to the :class:`Scheduler` constructor.
+
+    Returns
+    -------
+    dict
+        See :meth:`Scheduler.stats()`.
+    """
+    return Scheduler(**kwargs).send(messages)
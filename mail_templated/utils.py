@@ -5,8 +5,12 @@
 .. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
 """
 
+from itertools import islice
+
 from django.core import mail
 
+from .cache import template_cache
+from .conf import app_settings
 from .message import EmailMessage
 
 
@@ -92,3 +96,166 @@ def send_mail(template_name, context, from_email, recipient_list,
         template_name, context, from_email, recipient_list,
         connection=connection, **kwargs).send(clean=clean)
 
+
+def send_mass_mail(template_name, datatuple, from_email=None,
+                   fail_silently=False, auth_user=None, auth_password=None,
+                   connection=None, chunk_size=None, **kwargs):
+    """
+    Send a personalised email message to each recipient list using the same
+    template.
+
+    This is the templated counterpart of the standard
+    :func:`send_mass_mail()<django.core.mail.send_mass_mail>` function. The
+    template is loaded once, and then it is rendered for every item of the
+    ``datatuple`` with it's own context. The messages are rendered lazily and
+    passed to the email backend in chunks over a single connection, so that
+    the connection is opened only once for the whole mailing.
+
+    Arguments
+    ---------
+    template_name : str
+        |template_name|
+    datatuple : iterable
+        An iterable of ``(context, recipient_list)`` pairs. A separate message
+        is rendered and sent for each pair. It may be a generator, it is
+        consumed only once.
+
+    Keyword Arguments
+    -----------------
+    from_email : str
+        |from_email|
+    fail_silently : bool
+        See :func:`mail_templated.send_mail()`.
+    auth_user | str
+        See :func:`mail_templated.send_mail()`.
+    auth_password | str
+        See :func:`mail_templated.send_mail()`.
+    connection : EmailBackend
+        See :func:`mail_templated.send_mail()`.
+    chunk_size : int
+        The number of messages passed to the email backend at once. Defaults
+        to the ``MAIL_TEMPLATED_MASS_MAIL_CHUNK_SIZE`` setting.
+
+    Any other keyword arguments are passed to the
+    :class:`~mail_templated.EmailMessage` constructor of every message.
+
+    Returns
+    -------
+    int
+        The number of successfully delivered messages.
+
+    Note
+    ----
+    The email backends report only the number of sent messages for each
+    chunk, so the failed recipients can not be identified, especially with
+    ``fail_silently=True``. Use the :class:`~mail_templated.dispatch.Dispatcher`
+    or the :class:`~mail_templated.throttle.Scheduler` if you need to know
+    which messages failed. They send the messages one by one and collect the
+    failed ones in the ``errors`` list.
+    """
+    connection = connection or mail.get_connection(username=auth_user,
+                                                   password=auth_password,
+                                                   fail_silently=fail_silently)
+    messages = iter_rendered_messages(template_name, datatuple, from_email,
+                                      connection=connection, **kwargs)
+    return send_messages(messages, connection, chunk_size)
+
+
+def iter_rendered_messages(template_name, datatuple, from_email=None,
+                           **kwargs):
+    """
+    Lazily render a personalised message for each recipient list using the
+    same template.
+
+    This is a generator. Only one message is rendered at a time, so the
+    memory usage does not depend on the number of messages. Use it with
+    :func:`~mail_templated.send_messages()` to send a mailing of any size with
+    bounded memory usage.
+
+    Arguments
+    ---------
+    template_name : str
+        |template_name|
+    datatuple : iterable
+        An iterable of ``(context, recipient_list)`` pairs. A separate message
+        is rendered for each pair. It may be a generator, it is consumed
+        lazily.
+
+    Keyword Arguments
+    -----------------
+    from_email : str
+        |from_email|
+    clean : bool
+        If ``True``, remove any template specific properties from the
+        messages after rendering. Default is ``True``.
+
+    Any other keyword arguments are passed to the
+    :class:`~mail_templated.EmailMessage` constructor of every message.
+
+    Yields
+    ------
+    EmailMessage
+        Rendered message.
+    """
+    clean = kwargs.pop('clean', True)
+    alternatives = kwargs.pop('alternatives', None) or []
+    template = template_cache.get_template(template_name)
+    for context, recipient_list in datatuple:
+        # The alternatives list is extended on rendering, so it should not be
+        # shared between the messages.
+        message = EmailMessage(template_name, context, from_email,
+                               recipient_list, alternatives=list(alternatives),
+                               **kwargs)
+        message.template = template
+        message.render(clean=clean)
+        yield message
+
+
+def send_messages(messages, connection=None, chunk_size=None,
+                  fail_silently=False):
+    """
+    Send messages from any iterable in chunks over a single connection.
+
+    The messages are consumed lazily, and only one chunk is kept in memory at
+    a time. This is a counterpart of
+    :func:`~mail_templated.iter_rendered_messages()`, but it accepts any email
+    messages.
+
+    Arguments
+    ---------
+    messages : iterable
+        Email messages to send. It may be a generator.
+
+    Keyword Arguments
+    -----------------
+    connection : EmailBackend
+        See :func:`mail_templated.send_mail()`.
+    chunk_size : int
+        The number of messages passed to the email backend at once. Defaults
+        to the ``MAIL_TEMPLATED_MASS_MAIL_CHUNK_SIZE`` setting.
+    fail_silently : bool
+        See :func:`mail_templated.send_mail()`. Used only if the
+        ``connection`` is not specified.
+
+    Returns
+    -------
+    int
+        The number of successfully delivered messages.
+    """
+    connection = connection or mail.get_connection(fail_silently=fail_silently)
+    chunk_size = chunk_size or app_settings.MASS_MAIL_CHUNK_SIZE
+    messages = iter(messages)
+    sent = 0
+    # Keep the connection open between the chunks. The backend does not close
+    # the connection that it did not open itself.
+    new_connection = connection.open()
+    try:
+        while True:
+            chunk = list(islice(messages, chunk_size))
+            if not chunk:
+                break
+            sent += connection.send_messages(chunk) or 0
+    finally:
+        if new_connection:
+            connection.close()
+    return sent
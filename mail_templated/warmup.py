@@ -0,0 +1,173 @@
+"""
+.. module:: mail_templated.warmup
+   :synopsis: Discovery and precompilation of the email templates.
+
+.. moduleauthor:: Artem Rizhov <artem.rizhov@gmail.com>
+"""
+
+import fnmatch
+import io
+import logging
+import os
+import re
+from timeit import default_timer
+
+from django.conf import settings
+
+from .cache import template_cache
+
+logger = logging.getLogger('mail_templated')
+
+BASE_TEMPLATE = 'mail_templated/base.tpl'
+
+EXTENDS_RE = re.compile(r'{%\s*extends\s+["\']([^"\']+)["\']\s*%}')
+
+
+def get_template_dirs():
+    """
+    Get the directories of all template engines including the application
+    directories.
+    """
+    try:
+        from django.template import engines
+    except ImportError:
+        # Django < 1.8
+        return list(getattr(settings, 'TEMPLATE_DIRS', []))
+    dirs = []
+    for engine in engines.all():
+        for template_dir in getattr(engine, 'template_dirs', ()):
+            if template_dir not in dirs:
+                dirs.append(template_dir)
+    return dirs
+
+
+def find_templates():
+    """
+    Find all templates and their parents.
+
+    Returns
+    -------
+    dict
+        The names of the parent templates (``None`` if the template does not
+        extend another one) by the names of the templates. The first found
+        template with the same name wins, like in the template loaders.
+    """
+    templates = {}
+    for template_dir in get_template_dirs():
+        template_dir = str(template_dir)
+        for root, _, files in os.walk(template_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, template_dir).replace(os.sep, '/')
+                if name in templates:
+                    continue
+                try:
+                    with io.open(path, encoding='utf-8') as f:
+                        match = EXTENDS_RE.search(f.read())
+                except (IOError, OSError, UnicodeDecodeError):
+                    continue
+                templates[name] = match.group(1) if match else None
+    return templates
+
+
+def find_email_templates():
+    """
+    Find all templates that extend the base email template directly or via
+    other templates.
+
+    Returns
+    -------
+    list
+        The sorted template names.
+    """
+    templates = find_templates()
+    result = []
+    for name in templates:
+        seen = set()
+        parent = templates[name]
+        while parent is not None and parent not in seen:
+            if parent == BASE_TEMPLATE:
+                result.append(name)
+                break
+            seen.add(parent)
+            parent = templates.get(parent)
+    return sorted(result)
+
+
+def resolve_template_names(patterns):
+    """
+    Get the template names by the names or glob patterns.
+
+    Arguments
+    ---------
+    patterns : iterable or str
+        The template names or glob patterns like ``'email/*.html'``, or
+        ``'auto'`` for all email templates.
+
+    Returns
+    -------
+    list
+        The template names.
+    """
+    if patterns == 'auto':
+        return find_email_templates()
+    all_templates = None
+    names = []
+    for pattern in patterns:
+        if not any(char in pattern for char in '*?['):
+            names.append(pattern)
+            continue
+        if all_templates is None:
+            all_templates = sorted(find_templates())
+        names.extend(fnmatch.filter(all_templates, pattern))
+    return names
+
+
+def compile_templates(names):
+    """
+    Load the templates and put them into the template cache.
+
+    This also primes the cached template loader of Django if it is enabled.
+
+    Arguments
+    ---------
+    names : iterable
+        The template names.
+
+    Returns
+    -------
+    list
+        The ``(template_name, seconds, error)`` tuples. The ``error`` is the
+        exception raised on loading, or ``None``.
+    """
+    result = []
+    for name in names:
+        start = default_timer()
+        try:
+            template_cache.get_template(name)
+        except Exception as exc:
+            result.append((name, default_timer() - start, exc))
+        else:
+            result.append((name, default_timer() - start, None))
+    return result
+
+
+def warm_up(patterns=None):
+    """
+    Compile the templates specified by the ``MAIL_TEMPLATED_WARMUP_TEMPLATES``
+    setting or by the ``patterns`` argument.
+
+    This is done automatically on the application start. The errors are
+    logged, but not raised.
+    """
+    from .conf import app_settings
+    if patterns is None:
+        patterns = app_settings.WARMUP_TEMPLATES
+    if not patterns:
+        return []
+    result = compile_templates(resolve_template_names(patterns))
+    for name, seconds, error in result:
+        if error is not None:
+            logger.warning('Failed to compile email template %s: %r',
+                           name, error)
+    return result